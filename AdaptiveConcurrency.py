@@ -0,0 +1,59 @@
+import time
+
+from gevent.event import Event
+
+
+class AIMDLimiter(object):
+    """按AIMD（加性增、乘性减）自动调整同时请求数的限流器
+
+    每个请求成功且耗时不超过latencyTarget时，上限增加increase / 上限（即每一轮请求约加increase）；
+    请求超时、连接失败、服务器过载（429，503）或耗时超过latencyTarget时，上限乘以decrease，
+    为避免同一轮的多个失败连续减半，两次减小至少间隔latencyTarget秒
+    minLimit，maxLimit：同时请求数的下限与上限
+    initial：初始上限，默认为minLimit
+    latencyTarget：可接受的请求耗时（秒）
+    """
+    def __init__(self, minLimit=1, maxLimit=50, initial=None, latencyTarget=2.0, increase=1.0, decrease=0.5):
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.latencyTarget = latencyTarget
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(min(max(initial or minLimit, minLimit), maxLimit))
+        self.inFlight = 0
+        self._lastDecrease = 0.0
+        self._slotFree = Event()  # 有请求结束时置位，唤醒等待的协程
+
+    def acquire(self):
+        """占用一个请求名额，名额用完时阻塞当前协程"""
+        while self.inFlight >= int(self.limit):
+            self._slotFree.clear()
+            self._slotFree.wait()
+        self.inFlight += 1
+
+    def release(self, latency=None, congested=False):
+        """释放名额，给出latency时同时根据本次请求调整上限（见record()）
+
+        :param latency: 本次请求耗时（秒），为None表示名额未用于请求（如URL已解析过），不调整上限
+        :param congested: 本次请求是否超时、连接失败或被服务器拒绝
+        """
+        self.inFlight -= 1
+        if latency is not None: self.record(latency, congested)
+        self._slotFree.set()
+
+    def record(self, latency, congested=False):
+        """根据一次请求的耗时与是否拥塞调整上限，不释放名额
+
+        :param latency: 本次请求耗时（秒）
+        :param congested: 本次请求是否超时、连接失败或被服务器拒绝
+        """
+        if congested or latency > self.latencyTarget:
+            now = time.time()
+            if now - self._lastDecrease >= self.latencyTarget:
+                self.limit = max(self.minLimit, self.limit * self.decrease)
+                self._lastDecrease = now
+        else:
+            self.limit = min(self.maxLimit, self.limit + self.increase / self.limit)
+
+    def currentLimit(self):
+        return int(self.limit)
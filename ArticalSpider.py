@@ -1,23 +1,39 @@
+import argparse
 import logging
 import os
 import re
 import json
 import time
-import random
-import pickle
+from urllib.parse import urlsplit
 
-import chardet
+import gevent
 import gevent.monkey
 import requests
 from gevent.pool import Pool
 from gevent.event import Event
-from gevent.queue import Queue, Empty, Full
+from gevent.queue import Empty
 gevent.monkey.patch_all()
 
+from AdaptiveConcurrency import AIMDLimiter
 from AutoHtmlParser import HtmlParser
+from CharsetDetector import CharsetDetector
 from CreateTable import Artical
-from MD5URL import MD5
+from DigestSnapshot import SnapshotSeenSet
+from FrontierJournal import FrontierJournal
+from HostScheduler import HostScheduler
+from HtmlCache import HtmlCache, contentHash
+from HttpClient import HttpClient, RejectedResponse
+from LinkFilter import LinkFilter, normalizeUrl
+from LinkScorer import LinkScorer
+from MD5URL import MD5Bytes
+from ParseStage import ParseStage
+from RetryQueue import HostCircuitBreaker, RetryQueue
+from SeenSet import LayeredSeenSet, createSeenSet
+from Sharding import ShardRouter
+from SimHash import SimHashIndex
 from SQLManager import SQLManager
+from SpiderStats import SpiderStats
+from URLFrontier import PriorityFrontier, URLFrontier
 
 # logging config ----------
 logging.basicConfig(level=logging.INFO,
@@ -32,46 +48,169 @@ hdr.setFormatter(formatter)
 logger.addHandler(hdr)
 # logging config ----------
 
+_link = re.compile('<a[^>]+href="(http.*?)"(?:[^>]*>([^<]{0,64}))?')  # 匹配页面中的链接及链接文字
+_retryStatus = frozenset([408, 429, 500, 502, 503, 504])  # 可以重试的响应状态码
+
 
 class ArticalSpider(object):
     """协程捕捉URL爬虫并解析html，将结果存入数据库
-    maxsize: 队列存储的最大值（默认为1000）
-    poolSize：协程池最大同时激活greenlet个数（默认为5个）
+    maxsize: 队列内存热窗口存储的最大值，超出部分溢出到磁盘
+    poolSize：初始同时请求数，运行时在minPoolSize与maxPoolSize之间按AIMD自动调整
+    shard，shards：多进程分片爬取时本进程的分片编号与分片数（由ShardLauncher.py启动），
+        本进程只爬取一致性哈希分配给它的域名，其余链接交给所属分片，shard为None时为单进程爬取
     """
-    def __init__(self):
+    def __init__(self, shard=None, shards=1):
         self.evt = Event()  # 等待初始化
+        self.shard = shard
+        self.shards = shards
         self.initConfig()  # 初始化配置文件
+        self.stats = SpiderStats()  # 运行指标
         self.initModules()  # 初始化模块
 
-        self.q = Queue(maxsize=self.maxsize)  # 有界队列
+        # 内存有界、溢出到磁盘的队列（开启优先级时按分数先爬取可能是文章页的URL），并按域名限速调度
+        self.journal = FrontierJournal(self.fileName, self.journalCompactRecords)  # 队列追加日志
+        frontier = URLFrontier(self.maxsize, self.frontierPath) if self.scorer is None else \
+            PriorityFrontier(self.maxsize, self.frontierPath, self.scorer.score, self.priority.get('levels', 10))
+        self.q = HostScheduler(frontier,
+                               self.politeness.get('minDelay', 1.0),
+                               self.politeness.get('burst', 1),
+                               self.politeness.get('hostDelays', {}),
+                               self.politeness.get('windowSize', 1000),
+                               self.scorer.score if self.scorer is not None else None,
+                               self.politeness.get('hostWindow'),
+                               os.path.join(self.frontierPath, 'hosts'))  # 已达窗口上限的域名的URL暂存目录
         self.initQueue()  # 初始化队列
 
         self.crawlUrlsCount = 0  # 统计搜到的链接的个数
         self.crawlerID = 0  # 协程ID标志
-        self.pool = Pool(self.poolSize)  # 协程池
+        self.maxPoolSize = self.concurrency.get('maxPoolSize', self.poolSize)
+        self.limiter = AIMDLimiter(self.concurrency.get('minPoolSize', self.poolSize), self.maxPoolSize,
+                                   self.poolSize, self.concurrency.get('latencyTarget', 2.0))  # 自适应并发数
+        self.pool = Pool(self.maxPoolSize)  # 长期运行的工作者协程池
+        self.inFlight = 0  # 正在处理的URL数
+        self.retryQueue = RetryQueue(self.retry.get('maxAttempts', 3), self.retry.get('baseDelay', 2.0),
+                                     self.retry.get('maxDelay', 300.0))  # 失败URL的延迟重试
+        self.breaker = HostCircuitBreaker(self.retry.get('failureThreshold', 5), self.retry.get('openTime', 60.0),
+                                          self.retry.get('maxTrips', 5))  # 按域名熔断
+        self.finished = Event()  # 队列为空且没有正在处理的URL时置位
         self.isInitializeCompletely = False  # 是否初始化完成
 
         self.startTime = None  # 爬虫启动时间
+        self.lastSnapshot = time.time()  # 上次写入已解析URL快照的时间
 
     def initModules(self):
         """初始化模块"""
         logger.info('Initializing modules...')
-        self.htmlParser = HtmlParser()  # 加载智能解析模块
-        self.sqlManager = SQLManager()  # 加载数据库模块
-        logger.info('Reading url md5 from mysql...')
-        self.urlDict = self.sqlManager.getAllMd5()  # 加载已解析URL字典
+        self.httpClient = HttpClient(self.http.get('poolConnections', 100),
+                                     self.http.get('poolMaxsize', 10),
+                                     self.http.get('dnsTtl', 300),
+                                     maxPageBytes=self.http.get('maxPageBytes', 1048576),
+                                     contentTypes=self.http.get('contentTypes', ['text/html', 'application/xhtml+xml']),
+                                     dnsCacheSize=self.http.get('dnsCacheSize', 10000))  # 共享长连接池
+        self.charsetDetector = CharsetDetector(self.charset.get('sniffBytes', 4096),
+                                               self.charset.get('detectBytes', 32768),
+                                               self.charset.get('cacheSize', 10000))  # 在原始字节上确定编码
+        self.htmlParser = HtmlParser(self.httpClient, self.charsetDetector)  # 加载智能解析模块
+        self.scorer = LinkScorer(self.priority.get('maxPatterns', 100000), self.priority.get('learnWeight', 5.0)) \
+            if self.priority.get('enabled') else None  # URL优先级（是否可能是文章页）
+        self.router = ShardRouter(self.shard, self.shards, self.sharding.get('socketDir', 'shards'),
+                                  self.acceptLink, self.isIdle, self.stop) \
+            if self.shard is not None else None  # 分片之间的链接路由
+        self.parseStage = ParseStage(self.storeArtical, self.parseWorkers, self.parseQueueSize, self.stats,
+                                     self.checkFinished)  # 多进程解析
+        self.storedSet = None  # 已保存文章的md5集合（使用快照时），只在文章写入数据库后加入
+        self.sqlManager = SQLManager(stats=self.stats, replace=self.revisit, conf=self.conf,
+                                     onCommit=self.articlesCommitted)  # 加载数据库模块（重新爬取时覆盖旧行）
+        self.htmlCache = HtmlCache(self.htmlCacheConf['path'], self.htmlCacheConf.get('level', 6)) \
+            if self.htmlCacheConf.get('path') else None  # 原始html缓存
+        self.seenSet = self.loadSeenSet()  # 加载已解析URL集合（分片时只加载本分片的URL）
+        self.seeds = set()  # 本次运行尚未请求的起始URL的md5，不因已保存而跳过
+        self.linkFilter = LinkFilter(self.filterUrlsRegular, None if self.revisit else self.seenSet,
+                                     createSeenSet(self.seenSetConf))  # 链接准入
+        self.nearDuplicates = SimHashIndex(self.nearDuplicate.get('path') or None, self.nearDuplicate.get('distance', 3),
+                                           load=False) if self.nearDuplicate.get('enabled') else None  # 正文SimHash近似重复索引
+        self.simhashLoader = None
+        if self.nearDuplicates is not None and self.nearDuplicates.path is not None:
+            # 在后台协程中分块载入指纹文件，不延长启动时间，载入完毕前不判断近似重复
+            self.simhashLoader = gevent.spawn(self.nearDuplicates.load, 4096, gevent.sleep)
 
     def initConfig(self):
         """读取配置文件信息"""
         logger.info('Initializing config...')
         with open('data.conf') as json_file:
             data = json.load(json_file)
-            self.maxsize = data['maxUrlQueueSize']  # URL队列最大存储值
-            self.poolSize = data['poolSize']  # 协程池最大同时激活greenlet个数
-            self.fileName = data['urlQueueFileName']  # 队列url的保存文件名
+            self.conf = data  # 只读取一次，同时交给数据库模块
+            self.maxsize = data['maxUrlQueueSize']  # URL队列内存中最大存储值
+            self.frontierPath = data.get('frontierPath', 'frontier')  # URL队列溢出到磁盘的目录
+            self.poolSize = data['poolSize']  # 初始同时请求数
+            self.concurrency = data.get('concurrency', {})  # 自适应并发数（未配置时固定为poolSize）
+            self.retry = data.get('retry', {})  # 失败重试与按域名熔断
+            self.fileName = data['urlQueueFileName']  # 队列追加日志的文件名
+            self.journalCompactRecords = data.get('journalCompactRecords', 100000)  # 日志记录数超过该值时压缩
             self.startUrls = data['startUrls']  # 队列初始化url
             self.filterUrlsRegular = data['filterUrlsRegular']  # 过滤的url
-            self.saveTime = data['saveTime']  # 队列url定时保存到本地文件
+            self.saveTime = data['saveTime']  # 定时检查是否需要压缩队列日志
+            self.seenSetConf = data.get('seenSet', {})  # 已解析URL集合类型（精确集合或布隆过滤器）
+            self.seenSnapshot = data.get('seenSnapshot', {})  # 已解析URL集合的快照文件
+            self.politeness = data.get('politeness', {})  # 每个域名的访问频率限制
+            self.http = data.get('http', {})  # HTTP连接池配置
+            self.charset = data.get('charset', {})  # 网页编码检测配置
+            self.parseWorkers = data.get('parseWorkers', 0)  # 解析进程数（0表示CPU核数）
+            self.parseQueueSize = data.get('parseQueueSize', 100)  # 等待解析写入的最大页面数
+            self.metrics = data.get('metrics', {})  # 运行指标的HTTP端点与定时汇总日志
+            self.revisit = data.get('revisit', False)  # 重新爬取已解析的URL（条件请求，页面未变化时跳过）
+            self.htmlCacheConf = data.get('htmlCache', {})  # 原始html缓存
+            self.nearDuplicate = data.get('nearDuplicate', {})  # 近似重复文章检测
+            self.sharding = data.get('sharding', {})  # 多进程分片爬取
+            self.priority = data.get('priority', {})  # 按分数优先爬取可能是文章页的URL
+        if self.shard is not None:  # 每个分片使用各自的队列日志、溢出目录、指纹文件与指标端口
+            suffix = '.shard%d' % self.shard
+            self.fileName += suffix
+            self.frontierPath += suffix
+            if self.nearDuplicate.get('path'):
+                self.nearDuplicate = dict(self.nearDuplicate, path=self.nearDuplicate['path'] + suffix)
+            if self.seenSnapshot.get('path'):  # 分片数改变时域名归属改变，不能沿用旧快照
+                self.seenSnapshot = dict(self.seenSnapshot, path=self.seenSnapshot['path'] + '%s-%d' % (suffix, self.shards))
+            if self.metrics.get('port'): self.metrics = dict(self.metrics, port=self.metrics['port'] + self.shard)
+            if not self.parseWorkers: self.parseWorkers = max(1, (os.cpu_count() or 1) // self.shards)
+
+    def loadSeenSet(self):
+        """加载已解析URL集合
+
+        配置了快照文件时，已保存文章的md5（self.storedSet）只映射上次的快照，从数据库补读快照水位时间之后写入的行
+        （按inserted_at索引查询），启动时间与表的大小无关；本次运行请求过的其它URL（列表页、放弃的URL等）
+        只记录在内存集合中，不写入快照，与不使用快照时一样重启后会重新请求；
+        没有快照时读取数据库中的全部md5
+        """
+        accept = self.ownsUrl if self.router is not None else None
+        path = self.seenSnapshot.get('path')
+        if not path:
+            logger.info('Reading url md5 from mysql...')
+            return self.sqlManager.getAllMd5(createSeenSet(self.seenSetConf), accept)
+        storedSet = SnapshotSeenSet(path, self.seenSetConf.get('capacity', 1024))
+        if storedSet.watermark is None:
+            logger.info('No seen-url snapshot, reading url md5 from mysql...')
+            self.sqlManager.getAllMd5(storedSet, accept)
+        else:
+            since = storedSet.watermark - self.seenSnapshot.get('margin', 60)  # 其它进程的写入时间与时钟可能有偏差
+            logger.info('Mapped %d url digests from %s, reading rows inserted since %s...' % (
+                len(storedSet), path, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since))))
+            self.sqlManager.getAllMd5(storedSet, accept, since)
+        self.storedSet = storedSet
+        return LayeredSeenSet(createSeenSet(self.seenSetConf), storedSet)
+
+    def articlesCommitted(self, md5s):
+        """批量写入提交后调用，把已在数据库中的文章加入已保存文章的集合（之后写入快照）"""
+        if self.storedSet is None: return
+        for md5 in md5s: self.storedSet.add(bytes.fromhex(md5))
+
+    def checkpointSeenSet(self, background=True):
+        """把已保存文章的md5集合写成快照（定时检查时在线程池中写入，不阻塞抓取；结束时直接写入）"""
+        if self.storedSet is None: return
+        start = time.time()
+        count = self.storedSet.checkpoint(gevent.get_hub().threadpool.apply if background else None)
+        self.lastSnapshot = time.time()
+        if count is not None: logger.info('Wrote seen-url snapshot: %d digests (%.1fs)' % (count, time.time() - start))
 
     def initQueue(self):
         """初始化队列，提供起始url列表
@@ -80,22 +219,35 @@ class ArticalSpider(object):
         :return:
         """
         self.loadLastUrlQueue()
-        for url in self.startUrls[:self.maxsize]:
-            self.q.put(url)
+        for url in self.startUrls:
+            if self.router is not None and not self.ownsUrl(url): continue  # 由所属分片加入
+            url = self.linkFilter.admit(url, seed=True)
+            if url is not None:
+                self.seeds.add(MD5Bytes(url))
+                self.enqueue(url, score=1.0)
         self.isInitializeCompletely = True
         self.evt.set()
 
     def loadLastUrlQueue(self):
-        """加载上次保存的队列url"""
+        """重放队列日志，加载上次仍在队列中的url（已在日志中，不再重复记录）"""
         logger.info('Initializing queue...')
         hasLastUrls = False
-        if not os.path.exists(self.fileName): return hasLastUrls
-        with open(self.fileName, 'rb') as f:
-            for url in pickle.load(f)[:self.maxsize - 100]:
-                hasLastUrls = True
-                self.q.put(url.strip())  # 注意把空格删除
+        for url in self.journal.replay():
+            hasLastUrls = True
+            self.linkFilter.mark(url)
+            self.q.put(url)
         return hasLastUrls
 
+    def enqueue(self, url, low=False, score=None):
+        """url入队并记录到队列日志
+
+        :param low: 是否为低优先级url（队列中其余url取完后才调度）
+        :param score: url的分数（开启优先级时使用）
+        """
+        if low: self.q.putLow(url)
+        else: self.q.put(url, score=score)
+        self.journal.logPut(url)
+
     def getCrawlUrlsCount(self):
         """返回已捕捉到的URL数量"""
         return self.crawlUrlsCount
@@ -105,120 +257,316 @@ class ArticalSpider(object):
         return self.q.qsize()
 
     def saveQueueUrls(self):
-        """将队列内容拷贝到文件"""
-        # 拷贝队列进行遍历
-        logger.info('Save queue urls')
-        with open(self.fileName, 'wb') as f:
-            urls = list(self.q.queue)
-            pickle.dump(urls, f)
+        """压缩队列日志（每条入队出队记录已实时写入，这里只在日志过长时重写）"""
+        if not self.journal.needsCompaction(): return
+        count = self.journal.compact()
+        logger.info('Compact queue journal: %d urls' % count)
 
     def crawlURL(self, crawlerID):
-        """每个工作者，搜索新的url"""
-        # 为了减少协程的切换，每个新建的工作者会不断查找URL，直到队列空或满
-        # 实际上因为有界队列的原因，协程仍然会不断切换
-        while True:
-            if not self.isInitializeCompletely:  # 还未初始化完成则等待
-                self.evt.wait()
-            # 定时保存队列数据，以便下次恢复
-            if time.time() - self.startTime > self.saveTime:
-                self.saveQueueUrls()
-                self.startTime = time.time()
-
-            gevent.sleep(random.uniform(0, 1))  # 防止爬取频率过快
+        """长期运行的工作者，阻塞等待队列中的URL，直到所有URL处理完毕"""
+        # 工作者只在爬虫结束时退出，队列暂时为空时阻塞在q.get()上，不再反复创建和销毁greenlet
+        # 队列满时URL会溢出到磁盘，put()不会阻塞也不会丢失URL
+        # 先占用限流器的请求名额再取URL：取出URL即消耗了该域名的限速令牌，
+        # 若取出后再等待名额，名额释放时同一域名的多个请求会紧挨着发出，破坏域名的请求间隔
+        if not self.isInitializeCompletely:  # 还未初始化完成则等待
+            self.evt.wait()
+        while not self.finished.is_set():
+            self.limiter.acquire()
             try:
-                url = self.q.get(timeout=0.1)  # 当队列空时自动释放当前greenlet
-                md5_url = MD5(url)
-                if md5_url in self.urlDict: continue  # 如果已存在则抛弃
-                self.urlDict[md5_url] = True  # 加入字典
-
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36',
-                }
-                r = requests.get(url, timeout=5, headers=headers)
-                if r.status_code == 200:
-                    if r.encoding == 'ISO-8859-1':
-                        charset = self.detCharset(r.text)
-                        if charset != "" and charset.lower() in ['utf-8', 'gb2312', 'gbk']: r.encoding = charset
-                        else: r.encoding = chardet.detect(r.content)['encoding']  # 确定网页编码
+                try:
+                    url = self.q.get(timeout=1)  # 按域名限速取出URL，队列为空时阻塞当前greenlet
+                except Empty:  # 队列暂时为空，但其它工作者可能正在处理页面并加入新的URL
+                    self.checkFinished()
+                    continue
+                self.inFlight += 1  # 取出URL与计数之间没有协程切换，计数为0且队列为空时确实没有剩余工作
+                try:
+                    self.crawlPage(url)
+                except Exception:  # 未预料的异常（如数据库或解析错误）不能结束工作者，否则实际并发会逐渐减少
+                    self.stats.incr('workerError')
+                    logger.exception('Unexpected error crawling: ' + url)
+                    self.giveUp(url, MD5Bytes(url), 'unexpected error')
+                finally:
+                    self.inFlight -= 1
+                    self.checkFinished()
+            finally:
+                self.limiter.release()  # 请求的耗时已在fetchPage()中反馈给限流器
 
-                    # 插入数据库
-                    self.insertMysql(r.text, url, MD5(url))
-
-                    # 寻找下一个url
-                    for link in re.findall('<a[^>]+href="(http.*?)"', r.text):
-                        if len(self.filterUrlsRegular) != 0:
-                            for filterUrl in self.filterUrlsRegular:
-                                if filterUrl in link:
-                                    # 仅当队列中元素小于最大队列个数添加当前url到队列
-                                    self.q.put(link.strip(), timeout=0.1)  # 当队列满时自动释放当前greenlet
-                                    self.crawlUrlsCount += 1
-                                    break
-                        else:
-                            if len(link.strip()) != 0:
-                                self.q.put(link.strip(), timeout=0.1)
-                                self.crawlUrlsCount += 1
+    def isIdle(self):
+        """队列为空、没有正在处理的URL、没有等待重试的URL且所有页面的出链都已入队"""
+        return self.inFlight == 0 and self.q.empty() and len(self.retryQueue) == 0 and self.parseStage.pending() == 0
+
+    def checkFinished(self):
+        """空闲时通知所有工作者退出（分片爬取时其它分片还可能发来链接，由启动器判断所有分片都空闲后结束）"""
+        if self.router is None and self.isIdle(): self.finished.set()
+
+    def stop(self):
+        """结束爬取"""
+        self.finished.set()
+
+    def ownsUrl(self, url):
+        """url的域名是否由本分片负责"""
+        url = normalizeUrl(url)
+        return url is not None and self.router.owner(url) == self.shard
+
+    def acceptLink(self, url, low=False, anchor=None):
+        """接收其它分片发来的链接"""
+        self.stats.incr('linksRoutedIn')
+        self.enqueueLinks([(url, anchor)], low)
+
+    def crawlPage(self, url):
+        """抓取一个URL，解析结果交给解析进程池，页面中的新URL入队"""
+        try:
+            self.journal.logGet(url)
+            md5_url = MD5Bytes(url)
+            validators = None  # 重新爬取时上次保存的etag，last_modified，content_hash
+            if md5_url in self.seeds:  # 起始URL每次运行都请求一次，即使已保存为文章
+                self.seeds.discard(md5_url)
+            elif md5_url in self.seenSet:
+                if not self.revisit:  # 如果已存在则抛弃
+                    self.stats.incr('deduped')
+                    return
+                validators = self.sqlManager.getValidators(md5_url.hex())
+
+            host = urlsplit(url).netloc.lower()
+            if self.breaker.isDead(host):  # 域名多次熔断仍未恢复
+                self.giveUp(url, md5_url, 'host down')
+                return
+            blockedUntil = self.breaker.blockedUntil(host, time.time())
+            if blockedUntil is not None:  # 域名熔断中，暂存到熔断结束，不占用工作者
+                self.retryQueue.park(url, blockedUntil)
+                self.journal.logPut(url)
+                self.stats.incr('parked')
+                return
+
+            r = self.fetchPage(url, validators)
+            if r.status_code in _retryStatus:
+                self.retryLater(url, md5_url, 'status ' + str(r.status_code))
+                return
+            # 只有请求成功或放弃重试的URL才加入已解析集合
+            self.breaker.success(host)
+            self.retryQueue.done(url)
+            self.seenSet.add(md5_url)  # 加入集合
 
+            if r.status_code == 200:
+                self.stats.incr('fetched')
+                if r.truncated: self.stats.incr('truncated')
+                content = r.content
+                pageHash = contentHash(content)
+                with self.stats.timer('charset'):  # 确定网页编码并只解码一次
+                    html, charset = self.charsetDetector.decode(url, content, r.headers.get('Content-Type'))
+
+                if validators is not None and validators['content_hash'] == pageHash:  # 页面未变化，不再解析与写入
+                    self.stats.incr('unchanged')
+                    self.enqueueLinks(_link.findall(html))
+                    if self.scorer is not None: self.scorer.record(url, True)  # 未变化的文章页已在数据库中
                 else:
-                    logger.warning('Request error status: ' + str(r.status_code) + ': ' + url)
-                    # 这里可以进行重连（这里不写了）
-
-            except Empty:  # q.get()时队列为空异常
-                # logger.info('URL Queue is Empty! URLSpider-' + str(crawlerID) + ': stopping crawler...')
-                break
-            except Full:  # q.put()时队列为满异常
-                # logger.info('URL Queue is Full! URLSpider-' + str(crawlerID) + ': stopping crawler...')
-                break
-            except requests.exceptions.ConnectionError:  # 连接数过高，程序休眠
-                logger.warning('Connection refused')
-                time.sleep(3)
-            except requests.exceptions.ReadTimeout:  # 超时
-                logger.warning('Request readTimeout')
-                # 接下去可以尝试重连，这里不写了
-
-    def insertMysql(self, html, url, md5):
-        """将解析结果插入队列"""
-        parseDict = self.htmlParser.extract_offline(html)
+                    if self.htmlCache is not None: self.htmlCache.put(content, pageHash)
+                    links = _link.findall(html)
+                    if self.nearDuplicates is None:  # 不判断近似重复时立即入队，否则在解析后按是否近似重复入队
+                        self.enqueueLinks(links)
+                        links = ()
+                    # 插入数据库
+                    self.insertMysql(html, url, md5_url.hex(), {'etag': r.headers.get('ETag'),
+                                                                'last_modified': r.headers.get('Last-Modified'),
+                                                                'content_hash': pageHash},
+                                     links, validators is not None)
+
+            elif r.status_code == 304:  # 页面未修改，从缓存中读取页面继续寻找url
+                self.stats.incr('notModified')
+                content = self.htmlCache.get(validators['content_hash']) \
+                    if self.htmlCache is not None and validators and validators['content_hash'] else None
+                if content is not None: self.enqueueLinks(_link.findall(self.charsetDetector.decode(url, content)[0]))
+
+            else:  # 其余状态码（如404）重试也不会成功
+                self.stats.incr('non200')
+                logger.warning('Request error status: ' + str(r.status_code) + ': ' + url)
+
+        except RejectedResponse as e:  # 不是网页（pdf，图片，视频等）
+            self.seenSet.add(md5_url)
+            self.stats.incr('rejected')
+            logger.debug(str(e))
+        except requests.exceptions.Timeout:  # 超时
+            self.stats.incr('timeout')
+            self.retryLater(url, md5_url, 'timeout')
+        except requests.exceptions.ConnectionError:  # 连接失败（连接数过高或服务器不可用）
+            self.stats.incr('connectionError')
+            self.retryLater(url, md5_url, 'connection error')
+        except requests.exceptions.RequestException as e:  # 其它请求错误（如响应体传输中断）
+            self.stats.incr('requestError')
+            self.retryLater(url, md5_url, e.__class__.__name__)
+
+    def retryLater(self, url, md5, reason):
+        """记录域名失败，按退避时间延迟重试，用完重试次数时放弃"""
+        host = urlsplit(url).netloc.lower()
+        if self.breaker.failure(host, time.time()): self.stats.incr('circuitOpen')
+        if self.retryQueue.retry(url):
+            self.journal.logPut(url)  # 等待重试的URL仍记录在队列日志中，重启后可恢复
+            self.stats.incr('retried')
+            logger.debug('Retry later (%s): %s', reason, url)
+        else:
+            self.giveUp(url, md5, reason)
+
+    def giveUp(self, url, md5, reason):
+        """放弃URL，加入已解析集合不再请求"""
+        self.retryQueue.done(url)
+        self.seenSet.add(md5)
+        self.stats.incr('exhausted')
+        logger.warning('Give up (%s): %s' % (reason, url))
+
+    def fetchPage(self, url, validators=None):
+        """请求页面（调用者已占用限流器的名额），并把耗时与是否拥塞反馈给限流器"""
+        start = time.perf_counter()
+        congested = True  # 超时与连接失败以异常抛出，同样视为拥塞
+        try:
+            with self.stats.timer('fetch'):
+                r = self.httpClient.fetch(url, timeout=5, headers=self.conditionalHeaders(validators))  # 流式读取，非网页直接放弃
+            congested = r.status_code in (429, 503)  # 服务器过载
+            return r
+        except RejectedResponse:
+            congested = False
+            raise
+        finally:
+            self.limiter.record(time.perf_counter() - start, congested)
+
+    def conditionalHeaders(self, validators):
+        """根据上次保存的etag与last_modified生成条件请求头"""
+        if not validators: return None
+        headers = {}
+        if validators['etag']: headers['If-None-Match'] = validators['etag']
+        if validators['last_modified']: headers['If-Modified-Since'] = validators['last_modified']
+        return headers or None
+
+    def enqueueLinks(self, links, low=False):
+        """页面中的url规范化、过滤并去掉已解析或已入队的url后再入队
+
+        :param links: (url, 链接文字)列表
+        :param low: 是否作为低优先级url入队（近似重复页面的出链）
+        """
+        for link, anchor in links:
+            if self.router is not None:  # 其它分片负责的链接交给所属分片，由其判重后入队
+                link = normalizeUrl(link)
+                if link is None:
+                    self.stats.incr('linksRejected')
+                    continue
+                owner = self.router.owner(link)
+                if owner != self.shard:
+                    if self.linkFilter.matches(link):
+                        self.router.send(owner, link, low, anchor)
+                        self.stats.incr('linksRoutedOut')
+                    else:
+                        self.stats.incr('linksRejected')
+                    continue
+            link = self.linkFilter.admit(link)
+            if link is None:
+                self.stats.incr('linksRejected')
+                continue
+            self.enqueue(link, low, self.scorer.score(link, anchor) if self.scorer is not None and not low else None)
+            self.crawlUrlsCount += 1
+            self.stats.incr('linksQueued')
+
+    def insertMysql(self, html, url, md5, validators=None, links=(), known=False):
+        """将页面交给解析进程池，解析结果由storeArtical插入数据库（解析通道满时阻塞当前协程）
+
+        :param links: 页面中的链接，解析完成后入队
+        :param known: 数据库中是否已有该url（重新爬取），已有时不做近似重复判断
+        """
+        self.parseStage.submit(html, url, md5, (validators, links, known))
+
+    def storeArtical(self, parseDict, url, md5, extra):
+        """将解析结果插入数据库，近似重复的文章不插入，其出链作为低优先级url入队"""
+        validators, links, known = extra
+        if parseDict is None:  # 解析失败
+            self.enqueueLinks(links)
+            return
+        if self.nearDuplicates is not None and parseDict['simhash'] is not None:
+            if not known and self.nearDuplicates.ready and self.nearDuplicates.find(parseDict['simhash']) is not None:
+                self.stats.incr('nearDuplicate')
+                if self.scorer is not None: self.scorer.record(url, False)
+                logger.debug('Near duplicate: %s', url)
+                self.enqueueLinks(links, low=True)
+                return
+            self.nearDuplicates.add(parseDict['simhash'])
+        self.enqueueLinks(links)
         content = parseDict['content']
         description = parseDict['description']
         keyword = parseDict['keyword']
         title = parseDict['title']
+        if self.scorer is not None: self.scorer.record(url, content != "")  # 学习该形状的URL是否为文章页
         # 插入数据库
         if content != "":
-            self.sqlManager.insert(Artical(content=content, title=title, keyword=keyword, description=description, url=url, md5=md5))
-            logger.info('Insert Mysql: ' + url)
-
-    def detCharset(self, html):
-        """检测网页编码"""
-        charsetPattern = re.compile('<\s*meta[^>]*?charset=["]?(.*?)"?\s*[/]>?', re.I | re.S)
-        charset = charsetPattern.search(html)
-        if charset: charset = charset.groups()[0]
-        else: charset = ""
-        return charset
+            self.sqlManager.insert(Artical(content=content, title=title, keyword=keyword, description=description, url=url, md5=md5,
+                                           **(validators or {})))
+            logger.debug('Insert Mysql: %s', url)  # 逐个URL的日志只在DEBUG级别输出，运行情况见定时汇总
+        else:
+            self.stats.incr('emptyContent')
 
     def run(self):
-        """开启协程池，运行爬虫，在队列中无url时退出捕获"""
-        if self.q.qsize() == 0:
+        """开启长期运行的工作者，在队列中无url且没有正在处理的url时退出"""
+        if self.q.qsize() == 0 and self.router is None:  # 分片可以从空队列开始，等待其它分片发来链接
             logger.error('Please init Queue first (Check your .conf file)')
             return
-        logger.info('Starting crawler...')
+        logger.info('Starting crawler...' if self.router is None else 'Starting crawler shard %d/%d...' % (self.shard, self.shards))
         self.startTime = time.time()
-        while True:
-            # 当没有任何协程在工作，且队列中无url时退出捕获
-            if self.q.empty() and self.pool.free_count() == self.poolSize:
-                break
-
-            # 每次创建和队列中url个数一样的协程数
-            # 如果协程池所能同时工作的协程数小于url个数，则创建协程池所能同时工作的最大协程数
-            # 保证协程池总是在最多激活greenlet数状态
-            for _ in range(min(self.pool.free_count(), self.q.qsize())):
+        self.startMetrics()
+        try:
+            if self.router is not None: self.router.start()
+            # 工作者个数为并发上限，实际同时请求数由限流器控制
+            for _ in range(self.maxPoolSize):
                 self.crawlerID += 1
                 self.pool.spawn(self.crawlURL, self.crawlerID)
+            self.retryQueue.start(self.q.put)  # 到期的重试URL放回队列（已记录在队列日志中）
 
-            # 切换协程（因为只在遇到I/O才会自动切换协程）
-            gevent.sleep(0.1)
+            # 等待爬取结束，期间定时检查队列日志是否需要压缩
+            while not self.finished.wait(self.saveTime):
+                self.saveQueueUrls()
+                if self.nearDuplicates is not None: self.nearDuplicates.flush()
+                if time.time() - self.lastSnapshot >= self.seenSnapshot.get('interval', 600): self.checkpointSeenSet()
+        finally:
+            self.pool.kill()  # 结束时没有正在处理的URL，工作者都阻塞在q.get()上，可直接结束
+            self.retryQueue.stop()
+            self.parseStage.close()  # 等待已提交的页面解析完毕
+            if self.router is not None: self.router.close()
+            self.sqlManager.close()  # 写入数据库中剩余的批量插入数据
+            self.checkpointSeenSet(background=False)  # 在剩余的行写入之后，快照包含本次保存的所有文章
+            self.httpClient.close()
+            self.journal.compact()
+            self.journal.close()
+            if self.simhashLoader is not None: self.simhashLoader.kill()
+            if self.nearDuplicates is not None: self.nearDuplicates.close()
+            if self.storedSet is not None: self.storedSet.close()
+            self.stats.stop()
+        self.q.close()
+        logger.info('Stats: ' + self.stats.summary())
         logger.warning('All crawler stopping...')
 
+    def startMetrics(self):
+        """注册仪表，开启指标HTTP端点（/metrics，/stats）与定时汇总日志"""
+        self.stats.gauge('queueDepth', self.q.qsize)
+        self.stats.gauge('spilledUrls', self.q.frontier.spilled)
+        self.stats.gauge('inFlight', lambda: self.inFlight)
+        self.stats.gauge('retrying', self.retryQueue.__len__)
+        self.stats.gauge('concurrencyLimit', self.limiter.currentLimit)
+        self.stats.gauge('parsePending', self.parseStage.pending)
+        if self.router is not None: self.stats.gauge('routePending', self.router.pending)
+        if self.scorer is not None: self.stats.gauge('urlPatterns', self.scorer.patterns)
+        port = self.metrics.get('port', 0)
+        if port:
+            host = self.metrics.get('host', '127.0.0.1')
+            try:
+                self.stats.startServer(host, port)
+                logger.info('Metrics on http://%s:%d/metrics' % (host, port))
+            except OSError as e:  # 端口被占用等，只影响指标端点，不影响爬取
+                logger.warning('Metrics endpoint disabled, cannot bind %s:%d: %s' % (host, port, e))
+        interval = self.metrics.get('snapshotInterval', 10)
+        if interval > 0: self.stats.startReporter(interval, logger)
+
 
 if __name__ == '__main__':
-    urlSpider = ArticalSpider()
+    parser = argparse.ArgumentParser(description='Article spider')
+    parser.add_argument('--shard', type=int, help='shard index when started by ShardLauncher.py')
+    parser.add_argument('--shards', type=int, default=1, help='number of shards')
+    args = parser.parse_args()
+    if args.shard is not None:  # 各分片的输出写在一起，日志中标出分片编号
+        hdr.setFormatter(logging.Formatter('[%(asctime)s] shard' + str(args.shard) + ' %(name)s:%(levelname)s: %(message)s'))
+    urlSpider = ArticalSpider(args.shard, args.shards)
     urlSpider.run()
\ No newline at end of file
@@ -1,7 +1,9 @@
-import requests
 import re
 import math
-import chardet
+from bisect import bisect_left, bisect_right
+
+from CharsetDetector import CharsetDetector
+from HttpClient import HttpClient
 
 
 class HtmlParser(object):
@@ -16,7 +18,9 @@ class HtmlParser(object):
             1. 当前行的正文长度不小于30才将改行设为行块起点
             2. 当前行的正文长度不小于30，且接下去两行行正文长度均小于30才将改行设为行块终点
     """
-    def __init__(self):
+    def __init__(self, httpClient=None, charsetDetector=None):
+        self._httpClient = httpClient  # 在线解析使用的共享连接池，未指定时在首次在线解析时创建
+        self._charsetDetector = charsetDetector or CharsetDetector()  # 在线解析时确定网页编码
         # re.I: 忽略大小写，re.S: '.'可以代表任意字符包括换行符
         self._title = re.compile(r'<title>(.*?)</title>', re.I | re.S)  # 匹配标题
         self._keyword = re.compile(r'<\s*meta\s*name="?Keywords"?\s+content="?(.*?)"?\s*[/]?>', re.I | re.S)  # 匹配关键词
@@ -24,28 +28,30 @@ class HtmlParser(object):
         self._link = re.compile(r'<a(.*?)>|</a>')  # 匹配<a>，</a>标签
         self._link_mark = '|ABC|'  # 标记<a>，</a>  【在extract_content中会删除改标记，所以这里修改，那也得改】
         self._space = re.compile(r'\s+')  # 匹配所有空白字符，包括\r, \n, \t, " "
+        self._meta = re.compile(r'<\s*meta', re.I)  # 匹配<meta>标签开头
+        # 单次遍历html的词法规则，与remove_tag原先的多次替换顺序保持一致：
+        # space：&nbsp;，&#160;（还原为空格）
+        # drop：javascript，注释，css，其余字符实体如&copy;，&#12288;（直接去除，只匹配完整的实体，不吞掉其后的正文）
+        # link：<a>，</a>标签（替换为self._link_mark）
+        # tag：其余tag标记（直接去除，同时用于识别<title>与<meta>）
+        self._token = re.compile(r'(?P<space>&nbsp;|&#160;|&#xa0;)'
+                                 r'|(?P<drop><script.*?>.*?</script>|<!--.*?-->|<style.*?>.*?</style>'
+                                 r'|&(?:#\d+|#x[0-9a-f]+|[a-z][a-z0-9]*);)'
+                                 r'|(?P<link><a.*?>|</a>)'
+                                 r'|(?P<tag><[^>]*?>)', re.I | re.S)
         self._stopword = re.compile(
             r'备\d+号|Copyright\s*©|版权所有|all rights reserved|广告|推广|回复|评论|关于我们|链接|About|广告|下载|href=|本网|言论|内容合作|法律法规|原创|许可证|营业执照|合作伙伴|备案',
             re.I | re.S)
         self._punc = re.compile(r',|\?|!|:|;|。|，|？|！|：|；|《|》|%|、|“|”', re.I | re.S)
-        self._special_list = [(re.compile(r'&quot;', re.I | re.S), '\"'),  # 还原特殊字符
-                         (re.compile(r'&amp;', re.I | re.S), '&'),
-                         (re.compile(r'&lt;', re.I | re.S), '<'),
-                         (re.compile(r'&gt;', re.I | re.S), '>'),
-                         (re.compile(r'&nbsp;', re.I | re.S), ' '),
-                         (re.compile(r'&#34;', re.I | re.S), '\"'),
-                         (re.compile(r'&#38;', re.I | re.S), '&'),
-                         (re.compile(r'&#60;', re.I | re.S), '<'),
-                         (re.compile(r'&#62;', re.I | re.S), '>'),
-                         (re.compile(r'&#160;', re.I | re.S), ' '),
-                         ]
+        self._chinese = re.compile('[\u4e00-\u9fa5]')  # 匹配中文字符
 
     def extract_offline(self, html):
-        """离线解析html页面"""
-        title = self.extract_title(html)
-        description = self.extract_description(html)
-        keyword = self.extract_keywords(html)
-        content = self.extract_content(html, title)
+        """离线解析html页面（只遍历一次html）"""
+        lines, title, keyword, description = self.tokenize(html)
+        title = self._split_title(title)
+        keyword = self._space.sub(' ', keyword)
+        description = self._space.sub(' ', description)
+        content = self.extract_content(html, title, lines)
         return {
             'title': title,
             'description': description,
@@ -55,21 +61,11 @@ class HtmlParser(object):
 
     def extract_online(self, url):
         """在线解析html页面"""
-        r = requests.get(url)
+        if self._httpClient is None: self._httpClient = HttpClient()
+        r = self._httpClient.fetch(url)
         if r.status_code == 200:
-            if r.encoding == 'ISO-8859-1':
-                r.encoding = chardet.detect(r.content)['encoding']  # 确定网页编码
-            html = r.text
-            title = self.extract_title(html)
-            description = self.extract_description(html)
-            keyword = self.extract_keywords(html)
-            content = self.extract_content(html, title)
-            return {
-                'title': title,
-                'description': description,
-                'keyword': keyword,
-                'content': content
-            }
+            html, charset = self._charsetDetector.decode(url, r.content, r.headers.get('Content-Type'))  # 确定网页编码
+            return self.extract_offline(html)
         return {}
 
     def extract_title(self, html):
@@ -79,9 +75,11 @@ class HtmlParser(object):
         :return: 字符串，如果没有找到则返回空字符串
         """
         title = self._title.search(html)
-        if title: title = title.groups()[0]
+        if title: return self._split_title(title.groups()[0])
         else: return ''
-        # 如果标题由'_'组合而成，如"习近平告诉主要负责人改革抓什么_新闻_腾讯网"，则取字数最长的字符串作为标题
+
+    def _split_title(self, title):
+        """如果标题由'_'组合而成，如"习近平告诉主要负责人改革抓什么_新闻_腾讯网"，则取字数最长的字符串作为标题"""
         titleArr = re.split(r'_', title)
         newTitle = titleArr[0]
         for subTitle in titleArr:
@@ -115,11 +113,15 @@ class HtmlParser(object):
         keyword = self._space.sub(' ', keyword)
         return keyword
 
-    def extract_content(self, html, title):
-        """解析正文"""
-        lines = self.remove_tag(html)
+    def extract_content(self, html, title, lines=None):
+        """解析正文
+
+        :param lines: 已由remove_tag/tokenize得到的行列表，为None时重新处理html
+        """
+        if lines is None: lines = self.remove_tag(html)
         blocks = self.get_blocks(lines)
-        blockScores = self.block_scores(lines, blocks, title)
+        stats = BlockStats(self, lines, title, blocks)  # 每段只统计一次，区块置信度与长度均由前缀和得到
+        blockScores = self.block_scores(lines, blocks, title, stats)
         res = ""
         if len(blockScores) != 0:
             maxScore = max(blockScores)
@@ -131,9 +133,9 @@ class HtmlParser(object):
                 nextIndex = blockIndex + 1
                 while nextIndex < len(blocks):
                     # 如果区块字符低于30个字符，直接抛弃【这个可以根据需要改变，如果希望尽可能的捕捉所有内容可以注释改行】
-                    if self.detBlockLenght(lines, blocks, nextIndex) < 30: break
+                    if self.detBlockLenght(lines, blocks, nextIndex, stats) < 30: break
                     newBlock = (lineStart, blocks[nextIndex][1])
-                    score = self.block_scores(lines, [newBlock], title)[0]
+                    score = self.block_scores(lines, [newBlock], title, stats)[0]
                     if score > maxScore:
                         lineEnd = blocks[nextIndex][1]
                         maxScore = score
@@ -143,9 +145,9 @@ class HtmlParser(object):
                 lastIndex = blockIndex - 1
                 while lastIndex >= 0:
                     # 如果区块字符低于30个字符，直接抛弃【这个可以根据需要改变，如果希望尽可能的捕捉所有内容可以注释改行】
-                    if self.detBlockLenght(lines, blocks, nextIndex) < 30: break
+                    if self.detBlockLenght(lines, blocks, nextIndex, stats) < 30: break
                     newBlock = (blocks[lastIndex][0], lineEnd)
-                    score = self.block_scores(lines, [newBlock], title)[0]
+                    score = self.block_scores(lines, [newBlock], title, stats)[0]
                     if score > maxScore:
                         lineEnd = blocks[nextIndex][1]
                         maxScore = score
@@ -155,13 +157,12 @@ class HtmlParser(object):
                 res = re.sub('\|ABC\|(.*?)\|ABC\|', '', res, 0, re.I | re.S)  # 去除<a>内容
         return res
 
-    def detBlockLenght(self, lines, blocks, index):
-        """检测区块中字符长度"""
+    def detBlockLenght(self, lines, blocks, index, stats=None):
+        """检测区块中字符长度（去除<a>内容后）"""
         if len(blocks) <= index: return 0  # 索引越界
         lineStart, lineEnd = blocks[index]
-        block = ''.join(lines[lineStart:lineEnd])
-        block = re.sub('\|ABC\|(.*?)\|ABC\|', '', block, 0, re.I | re.S)  # 去除<a>内容
-        return len(block)
+        if stats is None: stats = BlockStats(self, lines, '', [blocks[index]])
+        return stats.textLength(lineStart, lineEnd)
 
     def get_blocks(self, lines):
         """得到所有含有正文的区块
@@ -190,7 +191,7 @@ class HtmlParser(object):
         '''
         return blocks
 
-    def block_scores(self, lines, blocks, title):
+    def block_scores(self, lines, blocks, title, stats=None):
         """计算区块的置信度
 
          - A： 当前区块<a> 标记占区块总行数比例  （标记越多，比例越高）【0.01 - 5】
@@ -206,21 +207,23 @@ class HtmlParser(object):
         :param lines: 列表，每一项为一行
         :param blocks: 列表，每一项为一个区块
         :param title: 字符串
+        :param stats: 由lines，title以及包含这些区块边界的区块列表得到的BlockStats，为None时重新计算
         :return: 列表，每一项为一个区块的置信度
         """
+        if stats is None: stats = BlockStats(self, lines, title, blocks)
         blockScores = []
         for indexStart, indexEnd in blocks:
             blockLinesLen = indexEnd - indexStart + 1.0
-            block = ''.join(lines[indexStart:indexEnd])
-            cleanBlock = block.replace(self._link_mark, '')
+            blockLen = stats.length(indexStart, indexEnd)
+            linkCount = stats.linkCount(indexStart, indexEnd)
 
-            linkScale = (block.count(self._link_mark) + 1.0) / blockLinesLen
+            linkScale = (linkCount + 1.0) / blockLinesLen
             lineScale = (len(lines) - indexStart + 1.0) / (len(lines) + 1.0)
-            stopScale = (len(self._stopword.findall(block)) + 1.0) / blockLinesLen
-            titleMatchScale = len(set(title) & set(cleanBlock)) / (len(title) + 1.0)
-            puncScale = (len(self._punc.findall(block)) + 1.0) / blockLinesLen
-            textScale = (len(cleanBlock) + 1.0) / blockLinesLen
-            chineseScale = len(re.findall("[\u4e00-\u9fa5]", block)) / len(block)
+            stopScale = (stats.stopwordCount(indexStart, indexEnd) + 1.0) / blockLinesLen
+            titleMatchScale = stats.titleMatchCount(indexStart, indexEnd) / (len(title) + 1.0)
+            puncScale = (stats.puncCount(indexStart, indexEnd) + 1.0) / blockLinesLen
+            textScale = (blockLen - linkCount * len(self._link_mark) + 1.0) / blockLinesLen
+            chineseScale = stats.chineseCount(indexStart, indexEnd) / blockLen
 
             score = chineseScale * textScale * lineScale * puncScale * (1.0 + titleMatchScale) / linkScale / math.pow(stopScale, 0.5)
             blockScores.append(score)
@@ -238,19 +241,138 @@ class HtmlParser(object):
         :param html: 未处理tag标记的html响应页面
         :return: 返回列表，每一项为一行
         """
-        for r, c in self._special_list: text = r.sub(c, html)  # 还原特殊字符
-        text = re.sub(r'<script(.*?)>(.*?)</script>', '', text, 0,  re.I | re.S)  # 去除javascript
-        text = re.sub(r'<!--(.*?)-->', '', text, 0, re.I | re.S)  # 去除注释
-        text = re.sub(r'<style(.*?)>(.*?)</style>', '', text, 0, re.I | re.S)  # 去除css
-        text = re.sub(r"&.{2,6};|&#.{2,5};", '', text)  # 去除如&nbsp等特殊字符
-        # text = re.sub(r"<a(.*?)>(.*?)</a>", '', text, 0, re.S)  # 去除链接标记
-        text = re.sub(r'<a(.*?)>|</a>', self._link_mark, text, 0, re.I | re.S)  # 将<a>, </a>标记换为|ATAG|
-        text = re.sub(r'<[^>]*?>', '', text, 0, re.I | re.S)  # 去除tag标记
-        lines = text.split('\n')
-        for lineIndex in range(len(lines)):  # 去除所有空白字符，包括\r, \n, \t, " "
-            lines[lineIndex] = re.sub(r'\s+', '', lines[lineIndex])
-        return lines
+        return self.tokenize(html)[0]
+
+    def tokenize(self, html):
+        """单次遍历html：去除tag标签（<a>，</a>替换为self._link_mark），同时得到标题、关键词、描述
+
+        :param html: 未处理tag标记的html响应页面
+        :return: (行列表, 标题, 关键词, 描述)，标题关键词描述为未处理的原始字符串，没有找到则为空字符串
+        """
+        pieces = []
+        append = pieces.append
+        linkMark = self._link_mark
+        pos = 0
+        title = keyword = description = None
+        titleStart = None
+        searching = True  # 标题、关键词、描述是否还有未找到的
+        for m in self._token.finditer(html):
+            start, end = m.span()
+            append(html[pos:start])
+            pos = end
+            kind = m.lastgroup
+            if kind == 'link':
+                append(linkMark)
+            elif kind == 'space':
+                append(' ')
+            elif kind == 'tag' and searching:
+                tag = m.group()
+                if title is None:  # 第一个<title>与其后第一个</title>之间的内容
+                    lowerTag = tag.lower()
+                    if titleStart is None:
+                        if lowerTag == '<title>': titleStart = end
+                    elif lowerTag == '</title>':
+                        title = html[titleStart:start]
+                if (keyword is None or description is None) and self._meta.match(tag):
+                    if keyword is None:
+                        match = self._keyword.search(tag)
+                        if match: keyword = match.groups()[0]
+                    if description is None:
+                        match = self._description.search(tag)
+                        if match: description = match.groups()[0]
+                searching = title is None or keyword is None or description is None
+        append(html[pos:])
+        # 去除所有空白字符，包括\r, \t, " "
+        lines = [self._space.sub('', line) for line in ''.join(pieces).split('\n')]
+        return lines, title or '', keyword or '', description or ''
+
+
+
+class BlockStats(object):
+    """区块边界处的前缀和统计
+
+    以所有区块的起止行为边界把行列表分段，每段只统计一次长度、<a>标记、停用词、标点、中文字符以及标题字符，
+    之后由这些边界组成的任意区块（lines[start:end]拼接成的字符串）的各项计数都可以O(1)得到，
+    结果与直接对拼接后的区块做正则匹配相同
+    parser：HtmlParser，提供各项正则
+    lines：列表，每一项为一行
+    title：字符串
+    blocks：列表，每一项为一个区块，查询时区块的起止行必须是其中某个区块的起点或终点
+    """
+    def __init__(self, parser, lines, title, blocks):
+        self._markLen = len(parser._link_mark)
+        points = sorted({0, len(lines)} | {index for block in blocks for index in block})
+        self._index = {point: k for k, point in enumerate(points)}  # 边界行 -> 前缀和下标
+        self._offsets = [0]  # 每个边界在全文中的位置
+        self._punc = [0]  # 标点数前缀和（单字符匹配，可逐段统计）
+        self._chinese = [0]  # 中文字符数前缀和
+        titleChars = set(title)
+        titleSegments = {c: [0] for c in titleChars}  # 标题中每个字符出现过的段数前缀和
+        segments = []
+        for k in range(1, len(points)):
+            segment = ''.join(lines[points[k - 1]:points[k]])
+            segments.append(segment)
+            self._offsets.append(self._offsets[-1] + len(segment))
+            self._punc.append(self._punc[-1] + len(segment) - len(parser._punc.sub('', segment)))
+            self._chinese.append(self._chinese[-1] + len(segment) - len(parser._chinese.sub('', segment)))
+            hits = titleChars.intersection(segment.replace(parser._link_mark, '')) if titleChars else ()
+            for c, prefix in titleSegments.items():
+                prefix.append(prefix[-1] + (c in hits))
+        self._titleSegments = list(titleSegments.values())
+
+        # 多字符匹配可能跨段，在全文上匹配后记录每个匹配的起止位置
+        text = ''.join(segments)
+        self._markStarts = [m.start() for m in re.finditer(re.escape(parser._link_mark), text)]
+        self._markEnds = [start + self._markLen for start in self._markStarts]
+        stopSpans = [m.span() for m in parser._stopword.finditer(text)]
+        self._stopStarts = [start for start, _ in stopSpans]
+        self._stopEnds = [end for _, end in stopSpans]
+
+        # 去除<a>内容时标记两两配对，按配对起点的奇偶分别做后缀和，得到任意区块中被去除的字符数
+        marks = self._markStarts
+        self._pairRemoved = [0] * (len(marks) + 2)
+        for j in range(len(marks) - 2, -1, -1):
+            self._pairRemoved[j] = marks[j + 1] + self._markLen - marks[j] + self._pairRemoved[j + 2]
+
+    @staticmethod
+    def _spanCount(starts, ends, begin, end):
+        """全文位置[begin, end)中完整包含的匹配个数"""
+        return max(0, bisect_right(ends, end) - bisect_left(starts, begin))
+
+    def length(self, start, end):
+        """区块字符数"""
+        return self._offsets[self._index[end]] - self._offsets[self._index[start]]
+
+    def linkCount(self, start, end):
+        """区块中<a>标记个数"""
+        return self._spanCount(self._markStarts, self._markEnds,
+                               self._offsets[self._index[start]], self._offsets[self._index[end]])
+
+    def stopwordCount(self, start, end):
+        """区块中停用词个数"""
+        return self._spanCount(self._stopStarts, self._stopEnds,
+                               self._offsets[self._index[start]], self._offsets[self._index[end]])
+
+    def puncCount(self, start, end):
+        """区块中标点符号个数"""
+        return self._punc[self._index[end]] - self._punc[self._index[start]]
+
+    def chineseCount(self, start, end):
+        """区块中中文字符个数"""
+        return self._chinese[self._index[end]] - self._chinese[self._index[start]]
+
+    def titleMatchCount(self, start, end):
+        """区块（去除<a>标记后）中出现的标题字符种数"""
+        start, end = self._index[start], self._index[end]
+        return sum(1 for prefix in self._titleSegments if prefix[end] > prefix[start])
 
+    def textLength(self, start, end):
+        """区块去除成对<a>标记及其之间内容后的字符数"""
+        first = bisect_left(self._markStarts, self._offsets[self._index[start]])
+        last = bisect_right(self._markEnds, self._offsets[self._index[end]])
+        pairs = max(0, last - first) // 2
+        removed = self._pairRemoved[first] - self._pairRemoved[first + 2 * pairs]
+        return self.length(start, end) - removed
 
 if __name__ == '__main__':
     # http://news.qq.com/  腾讯新闻主页
@@ -0,0 +1,106 @@
+import codecs
+import re
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import chardet
+
+_boms = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),  # UTF-32 LE的BOM以UTF-16 LE的BOM开头，需先判断
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+_metaCharset = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)  # <meta charset>与http-equiv两种写法
+_headerCharset = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+# 声明的编码常常是实际编码的子集，统一按超集解码，避免生僻字被替换
+_supersets = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'ascii': 'utf-8', 'big5': 'big5hkscs'}
+_latin1 = codecs.lookup('iso-8859-1').name
+
+
+def normalizeCharset(name):
+    """返回Python编解码器的规范名（按_supersets升级为超集），未知编码或非文本编解码器（如base64，rot13）返回None"""
+    if not name: return None
+    try:
+        info = codecs.lookup(name)
+    except LookupError:
+        return None
+    if not getattr(info, '_is_text_encoding', True): return None
+    return _supersets.get(info.name, info.name)
+
+
+class CharsetDetector(object):
+    """在原始字节上确定网页编码，页面只解码一次
+
+    依次使用：BOM，响应头Content-Type中的charset，前sniffBytes字节中的<meta charset>，
+    同域名上次成功解码的编码，最后才对前detectBytes字节做统计检测（chardet）；
+    响应头中的iso-8859-1常常是服务器的默认值而不是页面的实际编码，排在<meta charset>与域名缓存之后
+    sniffBytes：查找BOM与<meta charset>的字节数
+    detectBytes：统计检测使用的最大字节数
+    cacheSize：缓存编码的域名个数
+    """
+    def __init__(self, sniffBytes=4096, detectBytes=32768, cacheSize=10000):
+        self.sniffBytes = sniffBytes
+        self.detectBytes = detectBytes
+        self.cacheSize = cacheSize
+        self._hostCharsets = OrderedDict()  # 域名 -> 编码，按最近使用排序
+
+    def sniffBom(self, content):
+        """从BOM中读取编码，没有BOM时返回None"""
+        for bom, charset in _boms:
+            if content.startswith(bom): return charset
+        return None
+
+    def sniffMeta(self, content):
+        """从前sniffBytes字节的<meta charset>中读取编码，没有时返回None"""
+        match = _metaCharset.search(content, 0, self.sniffBytes)
+        if match: return normalizeCharset(match.group(1).decode('ascii'))
+        return None
+
+    def detect(self, url, content, contentType=None):
+        """确定页面编码
+
+        :param url: 页面URL，用于读取同域名缓存的编码
+        :param content: 响应的原始字节
+        :param contentType: 响应头Content-Type
+        :return: Python编解码器名
+        """
+        charset = self.sniffBom(content)
+        if charset is not None: return charset
+        match = _headerCharset.search(contentType) if contentType else None
+        header = normalizeCharset(match.group(1)) if match else None
+        if header is not None and header != _latin1: return header
+        charset = self.sniffMeta(content)
+        if charset is None: charset = self._hostCharsets.get(urlsplit(url).hostname)
+        if charset is None: charset = header
+        if charset is None:
+            charset = normalizeCharset(chardet.detect(content[:self.detectBytes])['encoding']) or 'utf-8'
+        return charset
+
+    def _remember(self, host, charset):
+        if host is None: return
+        self._hostCharsets[host] = charset
+        self._hostCharsets.move_to_end(host)
+        if len(self._hostCharsets) > self.cacheSize: self._hostCharsets.popitem(last=False)
+
+    def _forget(self, host, charset):
+        if self._hostCharsets.get(host) == charset: del self._hostCharsets[host]
+
+    def decode(self, url, content, contentType=None):
+        """确定编码并解码页面，非法字节替换为U+FFFD
+
+        页面能按该编码完整解码时才缓存为域名的编码（只解码一次），否则不缓存，
+        清除同域名缓存的该编码，再以替换模式解码
+        :return: (html, 编码)
+        """
+        charset = self.detect(url, content, contentType)
+        host = urlsplit(url).hostname
+        try:
+            html = content.decode(charset)
+        except UnicodeDecodeError:
+            self._forget(host, charset)
+            return content.decode(charset, 'replace'), charset
+        # BOM只说明当前页面；iso-8859-1能解码任意字节，解码成功不能说明编码正确，都不缓存
+        if charset != _latin1 and self.sniffBom(content) is None: self._remember(host, charset)
+        return html, charset
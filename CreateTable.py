@@ -1,26 +1,59 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, create_engine, VARCHAR
+from sqlalchemy import BigInteger, Column, create_engine, inspect, text, VARCHAR
 import json
 
 Base = declarative_base()
 
 
-def creteTable():
-    """创建所有表"""
-    with open('data.conf') as json_file:
-        mysql = json.load(json_file)['mysql']
-        username = mysql['username']
-        password = mysql['password']
-        host = mysql['host']
-        port = mysql['port']
-        db = mysql['db']
+def databaseUrl(conf):
+    """由配置（data.conf的内容）得到数据库连接URL：优先使用dbUrl，没有时按mysql配置连接Mysql"""
+    if conf.get('dbUrl'): return conf['dbUrl']
+    mysql = conf['mysql']
+    username = mysql['username']
+    password = mysql['password']
+    host = mysql['host']
+    port = mysql['port']
+    db = mysql['db']
 
-        # mysql+pymysql://<username>:<password>@<host>/<dbname>[?<options>] 【pymysql】
-        # mysql+mysqldb://<user>:<password>@<host>[:<port>]/<dbname>  【MySQL-Python】
-        # http://docs.sqlalchemy.org/en/latest/dialects/index.html --> mysql --> *
-        engine = create_engine("mysql+pymysql://" + username + ":" + password + "@" +
-                               host + ":" + port + "/" + db + "?charset=utf8", echo=True)
-        Base.metadata.create_all(engine)
+    # mysql+pymysql://<username>:<password>@<host>/<dbname>[?<options>] 【pymysql】
+    # mysql+mysqldb://<user>:<password>@<host>[:<port>]/<dbname>  【MySQL-Python】
+    # http://docs.sqlalchemy.org/en/latest/dialects/index.html --> mysql --> *
+    return "mysql+pymysql://" + username + ":" + password + "@" + host + ":" + port + "/" + db + "?charset=utf8"
+
+
+def creteTable(engine=None, conf=None):
+    """创建所有表（导入本模块不会连接数据库，需显式运行python CreateTable.py或调用本函数）
+
+    :param engine: 指定数据库引擎（如SQLite），默认按配置连接
+    :param conf: 已读取的配置字典，默认读取data.conf
+    """
+    if engine is None:
+        if conf is None:
+            with open('data.conf') as json_file:
+                conf = json.load(json_file)
+        engine = create_engine(databaseUrl(conf), echo=True)
+    Base.metadata.create_all(engine)
+    upgradeTable(engine)
+
+
+def upgradeTable(engine):
+    """为旧版本创建的artical表补上新增的列（etag，last_modified，content_hash，inserted_at）及其索引，已存在的列不变
+
+    :return: 新增的列名列表
+    """
+    inspector = inspect(engine)
+    existing = set(column['name'] for column in inspector.get_columns(Artical.__tablename__))
+    indexes = set(index['name'] for index in inspector.get_indexes(Artical.__tablename__))
+    added = []
+    with engine.begin() as conn:
+        for column in Artical.__table__.columns:
+            if column.name in existing: continue
+            conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+                Artical.__tablename__, column.name, column.type.compile(dialect=engine.dialect))))
+            added.append(column.name)
+    for index in Artical.__table__.indexes:
+        if index.name not in indexes: index.create(engine)
+    return added
 
 
 # 用户表
@@ -34,8 +67,15 @@ class Artical(Base):
     keyword = Column(VARCHAR(500))
     url = Column(VARCHAR(500))
     md5 = Column(VARCHAR(32), primary_key=True)
+    # 重新爬取（revisit）时用于条件请求与判断页面是否变化
+    etag = Column(VARCHAR(200))
+    last_modified = Column(VARCHAR(64))
+    content_hash = Column(VARCHAR(40))  # 页面原始字节的sha1，同时是HtmlCache中的键
+    # 写入时间（秒），启动时只从数据库补读已解析URL快照之后写入的行
+    inserted_at = Column(BigInteger, index=True)
 
     def __repr__(self):
         return '<md5=%s, url=%s>' % (self.md5, self.url)
 
-creteTable()
+if __name__ == '__main__':
+    creteTable()
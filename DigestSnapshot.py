@@ -0,0 +1,169 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+
+from SeenSet import DigestSet
+
+logger = logging.getLogger('ArticalSpider.DigestSnapshot')
+
+_magic = b'DGSTSNP1'
+_header = struct.Struct('<8sQd')  # 标记，摘要个数，水位时间
+_width = 16  # md5摘要字节数
+
+
+class DigestSnapshot(object):
+    """只读的已解析URL快照文件：文件头之后是按字节序排序的16字节md5摘要
+
+    打开时只映射文件（mmap），不读入内存，查找时在映射上二分查找，打开时间与摘要个数无关
+    path：快照文件
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = None
+        try:
+            header = self._file.read(_header.size)
+            if len(header) < _header.size: raise ValueError('Truncated digest snapshot: ' + path)
+            magic, self._count, self.watermark = _header.unpack(header)
+            if magic != _magic: raise ValueError('Not a digest snapshot: ' + path)
+            if os.fstat(self._file.fileno()).st_size != _header.size + self._count * _width:
+                raise ValueError('Digest snapshot size mismatch: ' + path)
+            if self._count: self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """第index个摘要（供bisect使用）"""
+        offset = _header.size + index * _width
+        return self._map[offset:offset + _width]
+
+    def __contains__(self, digest):
+        index = bisect.bisect_left(self, digest)
+        return index < self._count and self[index] == digest
+
+    def raw(self, start, end):
+        """第start到end个摘要的原始字节"""
+        if start >= end: return b''
+        return self._map[_header.size + start * _width:_header.size + end * _width]
+
+    def close(self):
+        if self._map is not None: self._map.close()
+        self._file.close()
+
+
+def sortedDigests(digests):
+    """按字节序依次返回digests（DigestSet）中的摘要
+
+    先按首字节分到256个桶（紧凑的bytearray），再逐桶排序，同时存在的摘要对象只有一个桶的量
+    """
+    buckets = [bytearray() for _ in range(256)]
+    for digest in digests: buckets[digest[0]] += digest
+    for bucket in buckets:
+        for digest in sorted(bytes(bucket[offset:offset + _width]) for offset in range(0, len(bucket), _width)):
+            yield digest
+
+
+def writeSnapshot(path, base, digests, watermark):
+    """合并已有快照与新摘要，写入新的快照文件（先写临时文件再替换）
+
+    新摘要按二分查找在已有快照中的位置，两个新摘要之间的已有部分整段复制
+    :param base: 已有快照（DigestSnapshot），为None时只写入新摘要
+    :param digests: 按字节序排列的新摘要
+    :param watermark: 快照的水位时间，此前写入数据库的行都已在快照中
+    :return: 快照中的摘要个数
+    """
+    tmpPath = path + '.tmp'
+    count = 0
+    with open(tmpPath, 'wb') as f:
+        f.write(_header.pack(_magic, 0, watermark))
+        start = 0
+        for digest in digests:
+            if base is not None:
+                index = bisect.bisect_left(base, digest, start)
+                f.write(base.raw(start, index))
+                count += index - start
+                start = index
+                if index < len(base) and base[index] == digest: continue  # 已在快照中
+            f.write(digest)
+            count += 1
+        if base is not None:
+            f.write(base.raw(start, len(base)))
+            count += len(base) - start
+        f.seek(0)
+        f.write(_header.pack(_magic, count, watermark))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
+    return count
+
+
+class SnapshotSeenSet(object):
+    """由快照文件与内存集合组成的摘要集合（爬虫用来保存已写入数据库的文章的md5）
+
+    启动时只映射上次的快照（DigestSnapshot），不读取数据库中的全部md5，之后加入的摘要存放在精确集合中；
+    checkpoint()把内存中的摘要合并进新的快照，快照的水位时间之后写入数据库的行由调用者补读
+    path：快照文件，不存在或损坏时从空集合开始（watermark为None，调用者应读取数据库全部md5）
+    capacity：没有快照（需要读取数据库全部md5）时内存集合的初始容量，有快照时内存集合只存放新增的摘要，从小容量开始
+    """
+    _deltaCapacity = 1024
+
+    def __init__(self, path, capacity=1024):
+        self.path = path
+        self.capacity = capacity
+        self.base = None
+        if os.path.exists(path):
+            try:
+                self.base = DigestSnapshot(path)
+            except ValueError as e:
+                logger.warning('Ignoring digest snapshot: %s' % e)
+        self.watermark = self.base.watermark if self.base is not None else None
+        self._delta = DigestSet(capacity if self.base is None else self._deltaCapacity)  # 快照之后加入的摘要
+        self._frozen = None  # 正在写入新快照的摘要
+
+    def __len__(self):
+        return (len(self.base) if self.base is not None else 0) + len(self._delta) + \
+               (len(self._frozen) if self._frozen is not None else 0)
+
+    def __contains__(self, digest):
+        return (self.base is not None and digest in self.base) or digest in self._delta or \
+               (self._frozen is not None and digest in self._frozen)
+
+    def add(self, digest):
+        """加入摘要，若已存在则返回False"""
+        if self.base is not None and digest in self.base: return False
+        if self._frozen is not None and digest in self._frozen: return False
+        return self._delta.add(digest)
+
+    def checkpoint(self, run=None):
+        """把内存中的摘要合并进新的快照
+
+        冻结当前内存集合，之后加入的摘要记在新的集合中，写入期间集合仍可查找与加入；
+        写入只读取已有快照与冻结的集合，可交给其它线程：run(func, args)
+        :param run: 执行写入的函数，为None时直接在当前线程写入
+        :return: 快照中的摘要个数，没有新摘要时不写入，返回None
+        """
+        if self._frozen is not None or (len(self._delta) == 0 and self.base is not None): return None
+        self._frozen, self._delta = self._delta, DigestSet(self._deltaCapacity)
+        watermark = time.time()  # 此前加入的摘要都在冻结的集合或已有快照中
+        try:
+            args = (self.path, self.base, sortedDigests(self._frozen), watermark)
+            count = writeSnapshot(*args) if run is None else run(writeSnapshot, args)
+        except BaseException:
+            for digest in self._frozen: self._delta.add(digest)
+            self._frozen = None
+            raise
+        old, self.base = self.base, DigestSnapshot(self.path)
+        self.watermark = watermark
+        self._frozen = None
+        if old is not None: old.close()  # 已替换的旧文件在关闭映射后释放
+        return count
+
+    def close(self):
+        if self.base is not None: self.base.close()
@@ -0,0 +1,79 @@
+import os
+
+
+class FrontierJournal(object):
+    """URL队列的追加日志，代替定时把整个队列序列化到文件
+
+    每次入队追加一行"+url"，每次出队追加一行"-url"，每条记录写入后立即交给操作系统，
+    因此保存的代价只与变化量有关，进程崩溃最多丢失正在写入的一条记录；
+    日志中的记录数超过compactRecords后，compact()把日志重写为只包含仍在队列中的URL
+    path：日志文件名
+    compactRecords：两次压缩之间允许追加的最大记录数
+    """
+    def __init__(self, path, compactRecords=100000):
+        self.path = path
+        self.compactRecords = compactRecords
+        self._records = 0  # 上次压缩以来追加的记录数
+        self._file = None
+
+    def replay(self):
+        """按入队顺序依次返回日志中仍在队列中的URL（流式读取，不会把日志全部载入内存）"""
+        if not os.path.exists(self.path): return
+        removed = self._removedCounts()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                self._records += 1
+                if not line.startswith('+'): continue
+                url = line[1:].rstrip('\n')
+                if removed.get(url, 0) > 0:  # 出队记录抵消最早的一次入队
+                    removed[url] -= 1
+                    continue
+                yield url
+
+    def _removedCounts(self):
+        """统计日志中每个URL的出队次数"""
+        removed = {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('-'):
+                    url = line[1:].rstrip('\n')
+                    removed[url] = removed.get(url, 0) + 1
+        return removed
+
+    def _append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8', buffering=1)  # 行缓冲，每条记录立即写入
+        self._file.write(record)
+        self._records += 1
+
+    def logPut(self, url):
+        """记录一次入队"""
+        self._append('+' + url + '\n')
+
+    def logGet(self, url):
+        """记录一次出队"""
+        self._append('-' + url + '\n')
+
+    def needsCompaction(self):
+        return self._records >= self.compactRecords
+
+    def compact(self):
+        """把日志重写为仍在队列中的URL，先写临时文件再替换，压缩过程中崩溃不会损坏日志
+
+        :return: 压缩后日志中的URL数
+        """
+        self.close()
+        tmpPath = self.path + '.tmp'
+        count = 0
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            for url in self.replay():
+                f.write('+' + url + '\n')
+                count += 1
+        os.replace(tmpPath, self.path)
+        self._records = count
+        return count
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,297 @@
+import bisect
+import heapq
+import itertools
+import os
+import shutil
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import gevent
+from gevent.event import Event
+from gevent.queue import Empty
+
+from URLFrontier import SegmentStore
+
+
+def _host(url):
+    return urlsplit(url).netloc.lower()
+
+
+class TokenBucket(object):
+    """令牌桶，每秒生成rate个令牌，最多积攒burst个
+
+    burst为1时等价于两次请求之间至少间隔1/rate秒
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def readyTime(self, now):
+        """返回下一个令牌可用的时间"""
+        self._refill(now)
+        if self.tokens >= 1: return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """消耗一个令牌"""
+        self._refill(now)
+        self.tokens -= 1
+
+
+class HostOverflow(object):
+    """某个域名已从队列取出、但因调度窗口中该域名的URL已达上限而暂存的URL，先进先出
+
+    前memorySize个保存在内存中，超出部分追加到该域名的磁盘段文件（SegmentStore），内存有界
+    memorySize：内存中最多保存的URL数
+    path：段文件目录，为None时全部保存在内存中
+    """
+    def __init__(self, memorySize, path=None):
+        self.memorySize = memorySize
+        self.path = path
+        self._memory = deque()
+        self._disk = None
+
+    def __len__(self):
+        return len(self._memory) + (len(self._disk) if self._disk is not None else 0)
+
+    def __iter__(self):
+        for url in self._memory: yield url
+        if self._disk is not None:
+            for url in self._disk: yield url
+
+    def append(self, url):
+        # 磁盘中还有URL时新URL也必须写入磁盘，保证先进先出
+        if self.path is None or (len(self._memory) < self.memorySize and not self._disk):
+            self._memory.append(url)
+            return
+        if self._disk is None: self._disk = SegmentStore(self.path)
+        self._disk.append(url)
+
+    def popleft(self):
+        """取出最早暂存的URL，没有时返回None"""
+        if self._memory: return self._memory.popleft()
+        return self._disk.popleft() if self._disk is not None else None
+
+    def close(self):
+        """关闭并删除磁盘段文件"""
+        if self._disk is None: return
+        self._disk.close()
+        self._disk = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class HostScheduler(object):
+    """按域名限速的URL调度器，包装URLFrontier并对外提供相同的队列接口
+
+    从队列中取出最多windowSize个URL按域名分组，get()返回下一个域名已就绪（有令牌）的URL，
+    某个域名冷却时其它域名的URL仍可被取出，协程池不会因单个域名限速而空闲
+    frontier：URL队列（URLFrontier）
+    minDelay：同一域名两次请求的最小间隔（秒），小于等于0表示不限速
+    burst：同一域名可连续请求的次数（令牌桶容量）
+    hostDelays：字典，为指定域名单独设置最小间隔
+    windowSize：调度窗口中最多缓存的URL数
+    hostWindow：每个域名在调度窗口中最多缓存的URL数，默认为windowSize的十分之一（不少于burst），
+        使一个URL很多的域名冷却时窗口中仍有其它域名的URL；补充窗口时取出的已达上限的域名的URL
+        暂存在该域名的溢出队列（HostOverflow）中，该域名的URL被取出、窗口有空位时再依次移入窗口，不放回队列
+    overflowPath：溢出队列的段文件目录（每个域名一个子目录，启动时清空），为None时溢出队列全部保存在内存中
+    scoreFunc：URL的分数（与PriorityFrontier一起使用），不为None时每个域名的URL按分数从高到低取出，
+        put()给出分数且域名已在调度窗口中时直接按分数插入窗口，不必排在窗口中已有的URL之后，
+        窗口超出windowSize时该域名分数最低的URL放回队列
+    """
+    def __init__(self, frontier, minDelay=1.0, burst=1, hostDelays=None, windowSize=1000, scoreFunc=None,
+                 hostWindow=None, overflowPath=None):
+        self.frontier = frontier
+        self.scoreFunc = scoreFunc
+        self.minDelay = minDelay
+        self.burst = burst
+        self.hostDelays = hostDelays or {}
+        self.windowSize = windowSize
+        self.hostWindow = hostWindow or max(burst, windowSize // 10)
+        self.overflowPath = overflowPath
+        if overflowPath is not None:  # 溢出段文件只是缓存，启动时清空上次残留
+            shutil.rmtree(overflowPath, ignore_errors=True)
+            os.makedirs(overflowPath)
+        self._hosts = {}  # 域名 -> 该域名待取出URL队列（按分数时为按(分数, -序号, url)升序排列的列表）
+        self._buckets = {}  # 域名 -> 令牌桶（None表示不限速）
+        self._ready = []  # (就绪时间, 序号, 域名) 最小堆，每个有待取出URL的域名恰好有一项
+        self._seq = itertools.count()
+        self._buffered = 0  # 调度窗口中的URL数
+        self._wake = Event()  # 有新URL加入时置位，唤醒所有阻塞在get()上的协程
+        self._queued = {}  # 域名 -> 队列中（尚未移入调度窗口）该域名的URL数
+        self._admissible = set()  # 队列中有URL且在窗口中未达到hostWindow的域名
+        self._overflow = {}  # 域名 -> 溢出队列（HostOverflow），只保存非空的
+        self._overflowed = 0  # 所有溢出队列中的URL数
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            delay = self.hostDelays.get(host, self.minDelay)
+            self._buckets[host] = TokenBucket(1.0 / delay, self.burst) if delay > 0 else None
+        return self._buckets[host]
+
+    def _readyTime(self, host, now):
+        bucket = self._bucket(host)
+        return bucket.readyTime(now) if bucket is not None else now
+
+    def _refresh(self, host):
+        """更新域名是否可以从队列中补充URL到窗口"""
+        if self._queued.get(host, 0) > 0 and len(self._hosts.get(host, ())) < self.hostWindow: self._admissible.add(host)
+        else: self._admissible.discard(host)
+
+    def _toFrontier(self, url, host, score=None, block=True, timeout=None):
+        """URL放入队列并计数"""
+        self.frontier.put(url, block, timeout, score)
+        self._queued[host] = self._queued.get(host, 0) + 1
+        self._refresh(host)
+
+    def _add(self, url, score=None):
+        """将URL加入调度窗口"""
+        host = _host(url)
+        if host not in self._hosts:
+            self._hosts[host] = deque() if self.scoreFunc is None else []
+            heapq.heappush(self._ready, (self._readyTime(host, time.time()), next(self._seq), host))
+        if self.scoreFunc is None:
+            self._hosts[host].append(url)
+        else:  # 分数相同时先加入的先取出
+            bisect.insort(self._hosts[host], (self.scoreFunc(url) if score is None else score, -next(self._seq), url))
+        self._buffered += 1
+        return host
+
+    def _park(self, url, host):
+        """URL暂存到域名的溢出队列"""
+        overflow = self._overflow.get(host)
+        if overflow is None:
+            path = os.path.join(self.overflowPath, host.replace(':', '_')) if self.overflowPath is not None else None
+            overflow = self._overflow[host] = HostOverflow(self.hostWindow, path)
+        overflow.append(url)
+        self._overflowed += 1
+
+    def _release(self, host):
+        """域名在窗口中有空位时，从溢出队列依次移入窗口"""
+        overflow = self._overflow.get(host)
+        while overflow is not None and len(self._hosts.get(host, ())) < self.hostWindow:
+            url = overflow.popleft()
+            if url is None: break
+            self._overflowed -= 1
+            self._add(url)
+        if overflow is not None and len(overflow) == 0:
+            overflow.close()
+            del self._overflow[host]
+
+    def _fill(self):
+        """从队列中取出URL直到调度窗口填满
+
+        已达到hostWindow的域名的URL移入该域名的溢出队列，继续为其它域名取URL，每个URL只从队列中取出一次；
+        队列中只剩已达到上限的域名的URL时不再取出；每次最多移入windowSize个溢出URL，避免长时间占用事件循环
+        :return: 是否因达到移入溢出队列的个数上限而停止（队列中可能还有其它域名的URL）
+        """
+        parked = 0
+        while self._buffered < self.windowSize and self._admissible:
+            if parked >= self.windowSize: return True
+            try:
+                url = self.frontier.get_nowait()
+            except Empty:
+                break
+            host = _host(url)
+            count = self._queued.get(host, 0) - 1
+            if count > 0: self._queued[host] = count
+            else: self._queued.pop(host, None)
+            if host in self._overflow or len(self._hosts.get(host, ())) >= self.hostWindow:
+                self._park(url, host)
+                parked += 1
+            else:
+                self._add(url)
+            self._refresh(host)
+        return False
+
+    def _take(self, host, now):
+        """取出已就绪域名的下一个URL并消耗令牌"""
+        heapq.heappop(self._ready)
+        urls = self._hosts[host]
+        url = urls.popleft() if self.scoreFunc is None else urls.pop()[2]
+        self._buffered -= 1
+        bucket = self._bucket(host)
+        if bucket is not None: bucket.take(now)
+        self._release(host)
+        if urls: heapq.heappush(self._ready, (self._readyTime(host, now), next(self._seq), host))
+        else: del self._hosts[host]
+        self._refresh(host)
+        return url
+
+    def put(self, url, block=True, timeout=None, score=None):
+        host = _host(url)
+        if self.scoreFunc is not None and score is not None and host in self._hosts:
+            self._add(url, score)
+            urls = self._hosts[host]
+            if (self._buffered > self.windowSize or len(urls) > self.hostWindow) and len(urls) > 1:
+                lowest, _, lowestUrl = urls.pop(0)  # 窗口已满，该域名分数最低的URL放回队列
+                self._buffered -= 1
+                self._toFrontier(lowestUrl, host, lowest)
+        else:
+            self._toFrontier(url, host, score, block, timeout)
+        self._wake.set()
+
+    def put_nowait(self, url):
+        self.put(url, False)
+
+    def putLow(self, url):
+        """加入低优先级URL（队列中其余URL取完后才调度）"""
+        self.frontier.putLow(url)
+        host = _host(url)
+        self._queued[host] = self._queued.get(host, 0) + 1
+        self._refresh(host)
+        self._wake.set()
+
+    def get(self, block=True, timeout=None):
+        """取出下一个域名已就绪的URL，timeout秒内没有可取出的URL时抛出Empty"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            more = self._fill()
+            now = time.time()
+            wait = None
+            if self._ready:
+                readyTime, _, host = self._ready[0]
+                if readyTime <= now: return self._take(host, now)
+                wait = readyTime - now
+            if more:  # 让出事件循环后继续补充窗口
+                gevent.sleep(0)
+                continue
+            if not block: raise Empty
+            if deadline is not None:
+                if deadline <= now: raise Empty
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            # 等待域名冷却的同时接收新加入的URL；新URL可能被其它协程移入调度窗口，所以在调度器上等待而不是在队列上等待
+            self._wake.clear()
+            self._wake.wait(wait)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self._buffered + self._overflowed + self.frontier.qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    @property
+    def queue(self):
+        """返回调度窗口、溢出队列与队列中的所有URL"""
+        if self.scoreFunc is None: urls = [url for hostUrls in self._hosts.values() for url in hostUrls]
+        else: urls = [item[2] for hostUrls in self._hosts.values() for item in reversed(hostUrls)]
+        urls += [url for overflow in self._overflow.values() for url in overflow]
+        return urls + self.frontier.queue
+
+    def close(self):
+        for overflow in self._overflow.values(): overflow.close()
+        self._overflow.clear()
+        self._overflowed = 0
+        self.frontier.close()
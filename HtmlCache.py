@@ -0,0 +1,53 @@
+import gzip
+import hashlib
+import os
+
+
+def contentHash(content):
+    """返回页面原始字节的sha1（十六进制），同时作为缓存的键"""
+    return hashlib.sha1(content).hexdigest()
+
+
+class HtmlCache(object):
+    """按内容寻址的本地原始html缓存，gzip压缩存储
+
+    文件路径为 path/<sha1前2位>/<sha1>.html.gz，内容相同的页面只保存一份，
+    已写入的文件不会再改变，因此可以在不重新抓取的情况下用新的解析算法重新解析
+    path：缓存目录
+    level：gzip压缩级别
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        if not os.path.exists(self.path): os.makedirs(self.path)
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key + '.html.gz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, content, key=None):
+        """保存页面原始字节（已存在时不重复写入）
+
+        :param key: 已计算好的contentHash(content)，为None时重新计算
+        :return: 缓存的键
+        """
+        if key is None: key = contentHash(content)
+        path = self._path(key)
+        if os.path.exists(path): return key
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory): os.makedirs(directory, exist_ok=True)
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmpPath, 'wb') as f:
+            f.write(gzip.compress(content, self.level))
+        os.replace(tmpPath, path)  # 先写临时文件再替换，不会留下写了一半的缓存文件
+        return key
+
+    def get(self, key):
+        """读取页面原始字节，不存在时返回None"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                return gzip.decompress(f.read())
+        except FileNotFoundError:
+            return None
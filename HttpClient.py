@@ -0,0 +1,127 @@
+import socket
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_defaultContentTypes = ('text/html', 'application/xhtml+xml')
+_defaultHeaders = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.87 Safari/537.36',
+}
+
+
+class DNSCache(object):
+    """缓存socket.getaddrinfo的解析结果，同一域名在ttl秒内不再重复解析
+
+    install()会替换socket.getaddrinfo，需在gevent.monkey.patch_all()之后调用，
+    这样实际解析仍使用gevent的协程版本
+    ttl：缓存时间（秒）
+    maxSize：最多缓存的解析结果数，超出时淘汰最久未使用的
+    """
+    def __init__(self, ttl=300, maxSize=10000):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self._cache = OrderedDict()  # (域名, 端口, ...) -> (过期时间, 解析结果)，按最近使用排序
+        self._getaddrinfo = None
+
+    def install(self):
+        if self._getaddrinfo is not None: return
+        self._getaddrinfo = socket.getaddrinfo
+        socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if self._getaddrinfo is None: return
+        socket.getaddrinfo = self._getaddrinfo
+        self._getaddrinfo = None
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.time()
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > now:
+            self._cache.move_to_end(key)
+            return cached[1]
+        result = self._getaddrinfo(host, port, family, type, proto, flags)
+        self._cache[key] = (now + self.ttl, result)
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxSize: self._cache.popitem(last=False)
+        return result
+
+
+_dnsCache = None  # 全局DNS缓存（整个进程只安装一次）
+
+
+class RejectedResponse(Exception):
+    """响应头表明内容不是可解析的网页（如pdf，图片，视频），未读取响应体"""
+    def __init__(self, url, contentType):
+        Exception.__init__(self, 'Rejected content type %s: %s' % (contentType, url))
+        self.url = url
+        self.contentType = contentType
+
+
+class HttpClient(object):
+    """共享的HTTP连接池，所有协程复用同一个Session，同一域名保持长连接
+
+    poolConnections：缓存连接池的域名个数
+    poolMaxsize：每个域名连接池的最大连接数
+    dnsTtl：DNS缓存时间（秒），小于等于0表示不缓存
+    dnsCacheSize：DNS缓存最多保存的解析结果数
+    headers：默认请求头（只构建一次）
+    maxPageBytes：fetch()读取响应体的最大字节数，超出部分丢弃，小于等于0表示不限制
+    contentTypes：fetch()接受的Content-Type，其余类型在收到响应头后立即放弃
+    """
+    def __init__(self, poolConnections=100, poolMaxsize=10, dnsTtl=300, headers=None,
+                 maxPageBytes=1048576, contentTypes=_defaultContentTypes, dnsCacheSize=10000):
+        global _dnsCache
+        self.maxPageBytes = maxPageBytes
+        self.contentTypes = frozenset(t.lower() for t in contentTypes)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolConnections, pool_maxsize=poolMaxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(headers or _defaultHeaders)
+        if dnsTtl > 0 and _dnsCache is None:
+            _dnsCache = DNSCache(dnsTtl, dnsCacheSize)
+            _dnsCache.install()
+
+    def get(self, url, **kwargs):
+        """发送GET请求，参数与requests.get相同"""
+        return self.session.get(url, **kwargs)
+
+    def fetch(self, url, **kwargs):
+        """流式获取网页，参数与requests.get相同
+
+        收到响应头后先检查Content-Type（没有该响应头时视为网页），不是网页时不读取响应体并抛出RejectedResponse；
+        响应体最多读取maxPageBytes字节，超出时截断并设置response.truncated为True，每个协程占用的内存有上限
+        :return: 已读取响应体的requests.Response（content为读取到的字节）
+        """
+        r = self.session.get(url, stream=True, **kwargs)
+        try:
+            if r.status_code == 200:
+                contentType = r.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+                if contentType and contentType not in self.contentTypes:
+                    raise RejectedResponse(url, contentType)
+            chunks, size = [], 0
+            r.truncated = False
+            for chunk in r.iter_content(65536):
+                chunks.append(chunk)
+                size += len(chunk)
+                if 0 < self.maxPageBytes <= size:
+                    r.truncated = True
+                    break
+            content = b''.join(chunks)
+            if r.truncated:
+                content = content[:self.maxPageBytes]
+                r.raw.close()  # 连接中还有未读取的数据，不能放回连接池复用
+            r._content = content
+            r._content_consumed = True
+        except BaseException:
+            r.raw.close()
+            raise
+        finally:
+            r.close()
+        return r
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,64 @@
+import re
+from urllib.parse import urlsplit, urlunsplit
+
+from MD5URL import MD5Bytes
+
+_defaultPorts = {'http': '80', 'https': '443'}
+
+
+def normalizeUrl(url):
+    """规范化URL，使同一页面的不同写法得到同一个URL
+
+    去除首尾空白与片段（#之后的部分），还原html中转义的&amp;，协议与域名转为小写，
+    去除默认端口，空路径补为/，查询参数按原文排序
+    :return: 规范化后的URL，无法解析时返回None
+    """
+    url = url.strip().replace('&amp;', '&')
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in _defaultPorts or not parts.hostname: return None
+    netloc = parts.hostname  # hostname已转为小写
+    if port is not None and str(port) != _defaultPorts[scheme]: netloc += ':%d' % port
+    if '@' in parts.netloc: netloc = parts.netloc.rsplit('@', 1)[0] + '@' + netloc
+    query = '&'.join(sorted(param for param in parts.query.split('&') if param))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+class LinkFilter(object):
+    """链接准入：规范化URL，用一个预编译的正则一次匹配所有过滤串，并在入队前拒绝已解析或已入队的URL
+
+    filters：过滤串列表（子串匹配，与filterUrlsRegular含义相同），为空时不过滤
+    seenSet：已解析URL集合（元素为16字节md5摘要），为None时不拒绝已解析的URL（重新爬取）
+    admittedSet：本次运行已准入（已入队）URL的集合，类型与seenSet相同
+    """
+    def __init__(self, filters, seenSet, admittedSet):
+        self._filter = re.compile('|'.join(re.escape(f) for f in filters)) if filters else None
+        self.seenSet = seenSet
+        self.admittedSet = admittedSet
+
+    def admit(self, url, seed=False):
+        """判断URL是否可以入队，可以时记录为已准入
+
+        :param seed: 为True时（起始URL）只判断是否已入队，不做过滤与已解析判断
+        :return: 规范化后的URL，不可入队时返回None
+        """
+        url = normalizeUrl(url)
+        if url is None: return None
+        if not seed and not self.matches(url): return None
+        md5 = MD5Bytes(url)
+        if md5 in self.admittedSet: return None
+        if not seed and self.seenSet is not None and md5 in self.seenSet: return None
+        self.admittedSet.add(md5)
+        return url
+
+    def matches(self, url):
+        """规范化后的URL是否通过过滤串"""
+        return self._filter is None or self._filter.search(url) is not None
+
+    def mark(self, url):
+        """把已在队列中的URL（如重放的队列日志）记录为已准入"""
+        self.admittedSet.add(MD5Bytes(url))
@@ -0,0 +1,75 @@
+import re
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+_digits = re.compile(r'\d+')
+# 文章页常见的路径：日期（/20170331/，/2017/03/31/，/2017-03-31/），较长的数字编号，带数字的静态页面
+_articlePath = re.compile(r'/(?:19|20)\d{2}[-/]?[01]\d[-/]?[0-3]\d(?:/|\d)|/\d{5,}|\d+\.s?html?$|/a/\d+', re.I)
+# 列表、标签、翻页、频道等不含正文的页面
+_listPath = re.compile(r'/(?:index|list|tags?|category|channel|column|search|topic|special|login|register)\b'
+                       r'|[?&](?:page|p|pn)=\d|/(?:page|p)/?\d{1,3}/?$|_\d{1,2}\.s?html?$', re.I)
+_navAnchor = re.compile(r'^\s*(?:首页|主页|下一页|上一页|尾页|更多|more|next|prev|返回|登录|注册|\d{1,3})\s*$', re.I)
+
+
+def urlPattern(url):
+    """URL的形状：域名 + 路径中的数字统一替换为N（如news.qq.com/a/N/N.htm），同一栏目的页面得到同一个形状"""
+    parts = urlsplit(url)
+    return parts.netloc.lower() + _digits.sub('N', parts.path)
+
+
+class LinkScorer(object):
+    """给待爬取URL打分（0到1，越大越可能是文章页），使优先级队列先爬取文章页
+
+    先由廉价特征得到先验分：路径深度，是否像文章页路径（日期、长数字编号），是否像列表/标签/翻页路径，
+    以及链接文字（文章标题通常为8到64个字，导航链接通常只有几个字）；
+    再按URL形状（urlPattern）统计已抓取页面中实际存入数据库的比例，样本越多越以统计结果为准
+    maxPatterns：最多记录的URL形状数，超出时淘汰最久未使用的
+    learnWeight：统计结果与先验分权重相等时的样本数
+    """
+    def __init__(self, maxPatterns=100000, learnWeight=5.0):
+        self.maxPatterns = maxPatterns
+        self.learnWeight = learnWeight
+        self._patterns = OrderedDict()  # URL形状 -> [已抓取页面数, 存入数据库的页面数]
+
+    def prior(self, url, anchor=None):
+        """由URL与链接文字得到的先验分"""
+        parts = urlsplit(url)
+        path = parts.path
+        depth = len([segment for segment in path.split('/') if segment])
+        score = 0.5
+        if depth == 0: score -= 0.3  # 首页
+        elif depth == 1: score -= 0.1
+        elif depth <= 4: score += 0.1
+        if _articlePath.search(path): score += 0.25
+        if _listPath.search(path + ('?' + parts.query if parts.query else '')): score -= 0.25
+        elif parts.query: score -= 0.05
+        if anchor:
+            anchor = anchor.strip()
+            if _navAnchor.match(anchor): score -= 0.2
+            elif len(anchor) >= 8: score += 0.15
+        return min(1.0, max(0.0, score))
+
+    def score(self, url, anchor=None):
+        """先验分与同形状页面的实际入库比例按样本数加权"""
+        score = self.prior(url, anchor)
+        counts = self._patterns.get(urlPattern(url))
+        if counts is None or counts[0] == 0: return score
+        fetched, stored = counts
+        weight = fetched / (fetched + self.learnWeight)
+        return (1 - weight) * score + weight * stored / fetched
+
+    def record(self, url, stored):
+        """记录一个已抓取并解析的页面是否存入了数据库"""
+        pattern = urlPattern(url)
+        counts = self._patterns.get(pattern)
+        if counts is None:
+            counts = self._patterns[pattern] = [0, 0]
+            if len(self._patterns) > self.maxPatterns: self._patterns.popitem(last=False)
+        else:
+            self._patterns.move_to_end(pattern)
+        counts[0] += 1
+        if stored: counts[1] += 1
+
+    def patterns(self):
+        """返回记录的URL形状数"""
+        return len(self._patterns)
@@ -6,4 +6,9 @@ def MD5(url):
     m.update(url.encode('utf-8'))
     return m.hexdigest()
 
-# print(type(md5('https://www.baidu.com/')))
\ No newline at end of file
+
+def MD5Bytes(url):
+    """返回16字节的原始md5摘要，用于已解析URL集合判重（避免生成十六进制字符串）"""
+    return hashlib.md5(url.encode('utf-8')).digest()
+
+# print(type(md5('https://www.baidu.com/')))
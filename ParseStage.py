@@ -0,0 +1,177 @@
+import logging
+import os
+import pickle
+import struct
+import subprocess
+import sys
+import time
+import traceback
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+
+from AutoHtmlParser import HtmlParser
+from SimHash import simhash
+
+logger = logging.getLogger('ArticalSpider.ParseStage')
+
+_parser = None  # 每个解析进程各自的HtmlParser
+_header = struct.Struct('!I')  # 消息头：消息体字节数
+
+
+def _extract(html):
+    """在解析进程中解析html页面并计算正文的SimHash（正文为空时为None），同时返回解析耗时（秒）"""
+    global _parser
+    if _parser is None: _parser = HtmlParser()
+    start = time.perf_counter()
+    parseDict = _parser.extract_offline(html)
+    parseDict['simhash'] = simhash(parseDict['content']) if parseDict['content'] else None
+    return parseDict, time.perf_counter() - start
+
+
+def _send(stream, obj):
+    body = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    stream.write(_header.pack(len(body)) + body)
+    stream.flush()
+
+
+def _recv(stream):
+    """读取一条消息，对端关闭时返回None"""
+    header = _readExactly(stream, _header.size)
+    if header is None: return None
+    body = _readExactly(stream, _header.unpack(header)[0])
+    if body is None: return None
+    return pickle.loads(body)
+
+
+def _readExactly(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk: return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _serve(stdin, stdout):
+    """解析进程主循环：从stdin读取html，把(是否成功, 解析结果或异常信息)写回stdout，stdin关闭时退出"""
+    while True:
+        html = _recv(stdin)
+        if html is None: break
+        try:
+            result = (True, _extract(html))
+        except Exception:
+            result = (False, traceback.format_exc())
+        _send(stdout, result)
+
+
+class _Worker(object):
+    """一个解析子进程，通过管道收发长度前缀的pickle消息
+
+    在gevent打补丁后创建时，subprocess的管道读写是协程友好的，等待解析结果不会阻塞整个gevent hub
+    """
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def call(self, html):
+        _send(self.process.stdin, html)
+        result = _recv(self.process.stdout)
+        if result is None: raise RuntimeError('Parse worker exited with code %s' % self.process.poll())
+        ok, payload = result
+        if not ok: raise RuntimeError(payload)
+        return payload
+
+    def close(self):
+        try:
+            self.process.stdin.close()  # 子进程读到EOF后退出
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class ParseStage(object):
+    """多进程解析阶段，使抓取协程不会因解析html（CPU密集）而阻塞整个gevent hub
+
+    抓取协程调用submit()把解码后的html交给空闲的解析进程后立即返回继续抓取，
+    解析结果按提交顺序经有界通道交给写入协程，由handler(parseDict, url, md5, extra)写入数据库（解析失败时parseDict为None）；
+    通道满时submit()阻塞当前协程，下游变慢时对抓取施加背压而不是无限堆积
+    解析进程通过管道通信，不使用concurrent.futures/multiprocessing的后台线程
+    （打补丁后这些线程变为协程，其阻塞的管道写入会使整个进程死锁）
+    handler：解析结果回调
+    workers：解析进程数，为None或0时等于CPU核数
+    maxPending：通道容量（已提交但尚未写入的页面数）
+    stats：SpiderStats，记录parse阶段耗时
+    onIdle：所有已提交页面的handler都返回时调用（无参数）
+    """
+    def __init__(self, handler, workers=None, maxPending=100, stats=None, onIdle=None):
+        self.handler = handler
+        self.stats = stats
+        self.onIdle = onIdle
+        self._workers = [_Worker() for _ in range(workers or os.cpu_count())]
+        self._idle = Queue()  # 空闲的解析进程
+        for worker in self._workers: self._idle.put(worker)
+        self.channel = Queue(maxsize=maxPending)
+        self._unfinished = 0  # 已提交但handler尚未返回的页面数
+        self._writer = gevent.spawn(self._drain)
+
+    def submit(self, html, url, md5, extra=None):
+        """提交一个页面进行解析，通道满时阻塞当前协程
+
+        :param extra: 原样交给handler的附加字段
+        """
+        result = AsyncResult()
+        self._unfinished += 1
+        self.channel.put((result, url, md5, extra))  # 先占用通道，同时等待解析的页面数不超过通道容量
+        gevent.spawn(self._parse, html, result)
+
+    def _parse(self, html, result):
+        """等待空闲的解析进程并解析页面，解析进程异常退出时换一个新的"""
+        worker = self._idle.get()
+        try:
+            result.set(worker.call(html))
+        except Exception as e:
+            if worker.process.poll() is not None:
+                self._workers.remove(worker)
+                worker = _Worker()
+                self._workers.append(worker)
+            result.set_exception(e)
+        finally:
+            self._idle.put(worker)
+
+    def _drain(self):
+        """写入协程：按提交顺序等待解析结果并交给handler"""
+        while True:
+            item = self.channel.get()
+            if item is None: break
+            result, url, md5, extra = item
+            try:
+                parseDict, seconds = result.get()
+                if self.stats is not None: self.stats.observe('parse', seconds)
+            except Exception:
+                logger.exception('Parse failed: ' + url)
+                parseDict = None
+            try:
+                self.handler(parseDict, url, md5, extra)
+            except Exception:
+                logger.exception('Store failed: ' + url)
+            finally:
+                self._unfinished -= 1
+            if self._unfinished == 0 and self.onIdle is not None: self.onIdle()
+
+    def pending(self):
+        """返回已提交但尚未写入的页面数"""
+        return self._unfinished
+
+    def close(self):
+        """等待所有已提交页面处理完毕并关闭解析进程"""
+        self.channel.put(None)
+        self._writer.join()
+        for worker in self._workers: worker.close()
+
+
+if __name__ == '__main__':
+    _serve(sys.stdin.buffer, sys.stdout.buffer)
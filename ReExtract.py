@@ -0,0 +1,261 @@
+"""批量重新解析：不重新抓取，用当前的HtmlParser重新解析已保存的页面并写回数据库
+
+    python ReExtract.py                       # 数据库中有content_hash的行，从htmlCache读取页面
+    python ReExtract.py --dir saved_pages     # 目录中的.html/.htm/.html.gz文件
+    python ReExtract.py --dry-run             # 只统计变化的文章数，不写入
+
+调整HtmlParser的阈值后运行，输出吞吐量以及解析结果变化的文章数
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+from urllib.parse import urljoin
+from urllib.request import pathname2url
+
+from sqlalchemy import select
+
+from AutoHtmlParser import HtmlParser
+from CharsetDetector import CharsetDetector
+from CreateTable import Artical
+from HtmlCache import HtmlCache, contentHash
+from MD5URL import MD5Bytes
+from SQLManager import SQLManager
+from SpiderStats import SpiderStats
+
+logger = logging.getLogger('ArticalSpider.ReExtract')
+
+_fields = ('title', 'description', 'keyword', 'content')  # 解析得到的列
+_md5Name = re.compile('^[0-9a-f]{32}$')  # 以url的md5命名的页面文件
+_pageSuffixes = ('.html.gz', '.htm.gz', '.html', '.htm')
+
+# 解析进程各自的模块（由_initWorker创建）
+_parser = None
+_charsetDetector = None
+_htmlCache = None
+
+
+def articleDigest(fields):
+    """文章解析结果（标题，描述，关键字，正文）的摘要，用于判断重新解析后是否变化"""
+    digest = hashlib.sha1()
+    for name in _fields:
+        digest.update((fields.get(name) or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.digest()
+
+
+def _initWorker(cachePath):
+    global _parser, _charsetDetector, _htmlCache
+    _parser = HtmlParser()
+    _charsetDetector = CharsetDetector()
+    _htmlCache = HtmlCache(cachePath) if cachePath else None
+
+
+def _readPage(kind, ref):
+    """读取页面原始字节，不存在时返回None"""
+    if kind == 'cache': return _htmlCache.get(ref) if _htmlCache is not None else None
+    try:
+        with open(ref, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    return gzip.decompress(content) if ref.endswith('.gz') else content
+
+
+def _reextract(task):
+    """在解析进程中读取并重新解析一个页面
+
+    :param task: (md5, url, 页面来源（cache或file）, 缓存键或文件路径, 数据库中的旧行信息或None)
+    :return: (状态, md5, url, 新的列或None, 旧行信息)，状态为changed，unchanged，empty，missing或failed
+    """
+    md5, url, kind, ref, old = task
+    try:
+        content = _readPage(kind, ref)
+        if content is None: return 'missing', md5, url, None, old
+        html = _charsetDetector.decode(url, content)[0]  # 保存的页面没有响应头，依次使用BOM，<meta charset>与统计检测
+        parseDict = _parser.extract_offline(html)
+    except Exception:
+        logger.exception('Re-extract failed: ' + url)
+        return 'failed', md5, url, None, old
+    if parseDict['content'] == '': return 'empty', md5, url, None, old
+    fields = {name: parseDict[name] for name in _fields}
+    fields['content_hash'] = ref if kind == 'cache' else contentHash(content)
+    if old is not None and old['digest'] == articleDigest(fields): return 'unchanged', md5, url, None, old
+    return 'changed', md5, url, fields, old
+
+
+class ReExtractor(object):
+    """并行重新解析已保存的页面，变化的文章批量覆盖写入数据库
+
+    页面按chunkSize个一组分给processes个解析进程（multiprocessing.Pool.imap_unordered），
+    解析进程自己读取缓存文件并解码，主进程只传递键与路径；
+    同时提交但尚未取回结果的页面不超过window个，来源（数据库按主键分页或目录遍历）按需读取，
+    因此内存占用与页面总数无关
+    解析结果与数据库中的旧行相同时不写入；正文为空时保留旧行
+    dbUrl：数据库连接URL，默认按data.conf
+    cachePath：原始html缓存目录，默认为data.conf中htmlCache的path
+    processes：解析进程数，为None或0时等于CPU核数
+    chunkSize：每次交给解析进程的页面数
+    window：同时在途的最大页面数，默认为processes * chunkSize * 4
+    dryRun：只统计，不写入数据库
+    """
+    def __init__(self, dbUrl=None, cachePath=None, processes=None, chunkSize=32, window=None, dryRun=False):
+        with open('data.conf') as json_file:
+            data = json.load(json_file)
+            if cachePath is None: cachePath = data.get('htmlCache', {}).get('path')
+        self.cachePath = os.path.abspath(cachePath) if cachePath else None
+        self.processes = processes or os.cpu_count()
+        self.chunkSize = chunkSize
+        self.window = window or self.processes * chunkSize * 4
+        self.dryRun = dryRun
+        self.stats = SpiderStats()
+        # 先创建解析进程，再创建带写入线程的数据库模块
+        self.pool = multiprocessing.Pool(self.processes, _initWorker, (self.cachePath,))
+        self.sqlManager = SQLManager(dbUrl, self.stats, replace=True, conf=data)  # 变化的文章覆盖旧行
+        self.md5ChunkSize = self.sqlManager.md5ChunkSize
+
+    def fromDatabase(self):
+        """数据库中所有有content_hash（已缓存原始html）的行
+
+        按主键分页（WHERE md5 > 上一页最后的md5），每页md5ChunkSize行，
+        不长时间占用游标，写回的同时读取也不会锁表
+        """
+        if self.cachePath is None: raise ValueError('htmlCache path is not configured')
+        columns = [Artical.md5, Artical.url, Artical.content_hash, Artical.etag, Artical.last_modified] + \
+                  [Artical.__table__.c[name] for name in _fields]
+        last = ''
+        while True:
+            statement = select(*columns).where(Artical.content_hash.isnot(None), Artical.md5 > last) \
+                .order_by(Artical.md5).limit(self.md5ChunkSize)
+            with self.sqlManager.engine.connect() as conn:
+                rows = conn.execute(statement).fetchall()
+            if not rows: break
+            for row in rows:
+                yield row.md5, row.url, 'cache', row.content_hash, self._oldRow(row)
+            last = rows[-1].md5
+
+    def fromDirectory(self, path):
+        """目录（递归）中的.html，.htm文件及其gzip压缩文件
+
+        文件名（去掉后缀）为32位md5时按md5对应数据库中的行，否则以file:// URL作为新文章
+        """
+        files = []
+        for filePath in self._walk(path):
+            files.append(filePath)
+            if len(files) >= self.md5ChunkSize:
+                for task in self._fileTasks(files): yield task
+                files = []
+        for task in self._fileTasks(files): yield task
+
+    def _walk(self, path):
+        """按需遍历目录，不一次性列出所有文件"""
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                for filePath in self._walk(entry.path): yield filePath
+            elif entry.name.endswith(_pageSuffixes):
+                yield os.path.abspath(entry.path)
+
+    def _fileTasks(self, files):
+        """为一组文件查询数据库中的旧行（一次查询）"""
+        keys = []
+        for filePath in files:
+            name = os.path.basename(filePath)
+            stem = name[:-len(next(s for s in _pageSuffixes if name.endswith(s)))]
+            if _md5Name.match(stem):
+                keys.append((stem, None))
+            else:
+                url = urljoin('file:', pathname2url(filePath))
+                keys.append((MD5Bytes(url).hex(), url))
+        olds = {}
+        if keys:
+            statement = select(Artical.md5, Artical.url, Artical.etag, Artical.last_modified,
+                               *[Artical.__table__.c[name] for name in _fields]) \
+                .where(Artical.md5.in_([md5 for md5, _ in keys]))
+            with self.sqlManager.engine.connect() as conn:
+                for row in conn.execute(statement):
+                    olds[row.md5] = (row.url, self._oldRow(row))
+        for filePath, (md5, url) in zip(files, keys):
+            oldUrl, old = olds.get(md5, (None, None))
+            if url is None: url = oldUrl
+            if url is None:  # 以md5命名但数据库中没有对应的行，不知道原URL
+                self.stats.incr('unknownMd5')
+                continue
+            yield md5, url, 'file', filePath, old
+
+    def _oldRow(self, row):
+        """数据库旧行中重新解析时需要保留或比较的信息"""
+        return {'digest': articleDigest({name: getattr(row, name) for name in _fields}),
+                'etag': row.etag, 'last_modified': row.last_modified}
+
+    def run(self, tasks, reportEvery=10000):
+        """重新解析所有页面并写回变化的文章
+
+        :param tasks: fromDatabase()或fromDirectory()
+        :return: 统计信息字典
+        """
+        slots = threading.BoundedSemaphore(self.window)
+
+        def windowed():
+            # imap_unordered在后台线程中读取全部任务，这里在取回结果前阻塞该线程，限制在途页面数
+            for task in tasks:
+                slots.acquire()
+                yield task
+
+        start = time.time()
+        count = 0
+        try:
+            for status, md5, url, fields, old in self.pool.imap_unordered(_reextract, windowed(), self.chunkSize):
+                slots.release()
+                count += 1
+                self.stats.incr(status)
+                if status == 'changed':
+                    if old is None: self.stats.incr('new')
+                    if not self.dryRun:
+                        self.sqlManager.insert(Artical(url=url, md5=md5, etag=old and old['etag'],
+                                                       last_modified=old and old['last_modified'], **fields))
+                if count % reportEvery == 0:
+                    logger.info('Re-extracted %d pages (%.1f pages/s): %s' % (
+                        count, count / (time.time() - start),
+                        ' '.join('%s=%s' % item for item in sorted(self.stats.counters.items()))))
+        except BaseException:
+            self.pool.terminate()  # 读取任务的后台线程可能阻塞在窗口上，不能等待其结束
+            raise
+        else:
+            self.pool.close()
+            self.pool.join()
+        finally:
+            self.sqlManager.close()
+        elapsed = time.time() - start
+        result = {'pages': count, 'seconds': round(elapsed, 1),
+                  'pagesPerSec': round(count / elapsed, 2) if elapsed > 0 else 0.0}
+        result.update(self.stats.counters)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-run HtmlParser over stored pages without crawling again')
+    parser.add_argument('--dir', help='read .html/.htm(.gz) files under this directory instead of the database')
+    parser.add_argument('--db-url', help='database URL (default: data.conf)')
+    parser.add_argument('--cache', help='raw html cache directory (default: data.conf htmlCache.path)')
+    parser.add_argument('--processes', type=int, default=0, help='parse processes, 0 = CPU count')
+    parser.add_argument('--chunk-size', type=int, default=32, help='pages handed to a process at a time')
+    parser.add_argument('--dry-run', action='store_true', help='count changed articles without writing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(name)s:%(levelname)s: %(message)s')
+    reExtractor = ReExtractor(args.db_url, args.cache, args.processes, args.chunk_size, dryRun=args.dry_run)
+    tasks = reExtractor.fromDirectory(args.dir) if args.dir else reExtractor.fromDatabase()
+    result = reExtractor.run(tasks)
+    logger.info('Re-extracted %d pages in %.1fs (%.2f pages/s), %d articles changed' % (
+        result['pages'], result['seconds'], result['pagesPerSec'], result.get('changed', 0)))
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
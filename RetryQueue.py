@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import random
+import time
+
+import gevent
+from gevent.event import Event
+
+
+class RetryQueue(object):
+    """延迟重试队列：按到期时间排序的最小堆，到期的URL由后台协程放回URL队列
+
+    第n次失败后等待 min(maxDelay, baseDelay * 2^(n-1)) 秒，再乘以[1 - jitter, 1 + jitter]内的随机数，
+    避免同一时刻失败的URL同时重试；失败次数达到maxAttempts后不再重试
+    maxAttempts：每个URL最多请求次数
+    baseDelay：第一次重试前的等待时间（秒）
+    maxDelay：重试等待时间上限（秒）
+    jitter：随机抖动比例
+    """
+    def __init__(self, maxAttempts=3, baseDelay=2.0, maxDelay=300.0, jitter=0.5):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self._heap = []  # (到期时间, 序号, url)
+        self._seq = itertools.count()
+        self._attempts = {}  # url -> 已失败次数（只保存正在等待重试的URL）
+        self._changed = Event()  # 加入新的URL时置位，唤醒后台协程重新计算等待时间
+        self._pump = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, url, due):
+        heapq.heappush(self._heap, (due, next(self._seq), url))
+        self._changed.set()
+
+    def retry(self, url):
+        """记录一次失败，未达到最大请求次数时按退避时间加入重试堆
+
+        :return: 加入重试堆时返回True，已用完重试次数时返回False
+        """
+        attempts = self._attempts.get(url, 0) + 1
+        if attempts >= self.maxAttempts:
+            self._attempts.pop(url, None)
+            return False
+        self._attempts[url] = attempts
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (attempts - 1))
+        self._push(url, time.time() + delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+        return True
+
+    def park(self, url, until):
+        """把URL暂存到until时刻（不计入失败次数），用于熔断中的域名"""
+        self._push(url, until)
+
+    def done(self, url):
+        """URL请求成功或放弃，清除失败次数"""
+        self._attempts.pop(url, None)
+
+    def attempts(self, url):
+        return self._attempts.get(url, 0)
+
+    def popDue(self, now):
+        """取出所有已到期的URL"""
+        urls = []
+        while self._heap and self._heap[0][0] <= now:
+            urls.append(heapq.heappop(self._heap)[2])
+        return urls
+
+    def start(self, callback):
+        """开启后台协程，每个URL到期时调用callback(url)"""
+        def pump():
+            while True:
+                self._changed.clear()
+                for url in self.popDue(time.time()):
+                    callback(url)
+                wait = self._heap[0][0] - time.time() if self._heap else None
+                self._changed.wait(wait)
+        self._pump = gevent.spawn(pump)
+        return self._pump
+
+    def stop(self):
+        if self._pump is not None: self._pump.kill()
+
+    @property
+    def queue(self):
+        """按到期顺序返回所有等待重试的URL"""
+        return [url for _, _, url in sorted(self._heap)]
+
+
+class HostCircuitBreaker(object):
+    """按域名的熔断器
+
+    同一域名连续失败failureThreshold次后熔断openTime秒，期间该域名的URL直接暂存而不占用工作者；
+    熔断结束后放行请求，成功则恢复，再次失败则重新熔断；连续熔断maxTrips次仍未恢复时认为该域名已失效
+    failureThreshold：触发熔断的连续失败次数
+    openTime：每次熔断的时间（秒）
+    maxTrips：认为域名失效的连续熔断次数
+    """
+    def __init__(self, failureThreshold=5, openTime=60.0, maxTrips=5):
+        self.failureThreshold = failureThreshold
+        self.openTime = openTime
+        self.maxTrips = maxTrips
+        self._failures = {}  # 域名 -> 连续失败次数
+        self._openUntil = {}  # 域名 -> 熔断结束时间
+        self._trips = {}  # 域名 -> 连续熔断次数
+
+    def blockedUntil(self, host, now):
+        """返回域名熔断结束的时间，未熔断时返回None"""
+        until = self._openUntil.get(host)
+        if until is None: return None
+        if until <= now:  # 熔断结束，放行请求试探域名是否恢复
+            del self._openUntil[host]
+            return None
+        return until
+
+    def isDead(self, host):
+        return self._trips.get(host, 0) >= self.maxTrips
+
+    def success(self, host):
+        self._failures.pop(host, None)
+        self._trips.pop(host, None)
+
+    def failure(self, host, now):
+        """记录一次失败，达到阈值时熔断
+
+        :return: 本次失败是否触发熔断
+        """
+        if self._openUntil.get(host, 0) > now: return True  # 同时发出的请求在熔断后失败，不重复计数
+        failures = self._failures.get(host, 0) + 1
+        if failures < self.failureThreshold and self._trips.get(host, 0) == 0:
+            self._failures[host] = failures
+            return False
+        # 熔断过的域名试探请求失败时立即重新熔断
+        self._failures.pop(host, None)
+        self._trips[host] = self._trips.get(host, 0) + 1
+        self._openUntil[host] = now + self.openTime
+        return True
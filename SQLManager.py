@@ -1,36 +1,294 @@
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import mysql as mysqlDialect
+from sqlalchemy.exc import DisconnectionError, IntegrityError, InterfaceError, OperationalError, SQLAlchemyError, \
+    TimeoutError
 import json
+import logging
+import threading
+import time
 
-from CreateTable import Artical
+from CreateTable import Artical, databaseUrl
+from SeenSet import createSeenSet
+
+logger = logging.getLogger('ArticalSpider.SQLManager')
+
+# 暂时性错误：连接断开、锁等待超时、死锁、连接池超时等，稍后重试可能成功
+_transientErrors = (OperationalError, InterfaceError, DisconnectionError, TimeoutError)
+
+
+class BatchWriter(object):
+    """延迟批量写入，攒够batchSize行或距上次写入超过interval秒时一次性批量插入
+
+    md5重复的行会被忽略（Mysql使用INSERT IGNORE，SQLite使用INSERT OR IGNORE），不会导致整批失败；
+    replace为True时md5重复的行覆盖旧行（Mysql使用ON DUPLICATE KEY UPDATE，SQLite使用INSERT OR REPLACE）；
+    暂时性错误（连接断开、锁等待超时等）按指数退避重试，重试retries次仍失败时保留这些行，下次写入时再试；
+    其它错误（如严格模式下某一行过长）改为逐行插入，只跳过出错的行
+    engine：数据库引擎
+    table：写入的表
+    batchSize：每批最多行数
+    interval：两次写入的最长间隔（秒）
+    stats：SpiderStats，记录insert阶段（每批）耗时与写入行数
+    replace：是否覆盖已存在的行（重新爬取时使用）
+    retries：暂时性错误的重试次数
+    retryDelay：第一次重试前等待的秒数，之后每次加倍，最多maxRetryDelay秒
+    onCommit：每批写入提交后以该批已在表中的行的主键列表调用（在写入线程中），出错被跳过或暂未写入的行不包括在内
+    """
+    _ignorePrefix = {'mysql': 'IGNORE', 'sqlite': 'OR IGNORE'}
+    _maxPendingBatches = 10  # 待写入行超过batchSize的该倍数时由调用者直接写入，防止无限增长
+
+    def __init__(self, engine, table, batchSize=200, interval=0.5, stats=None, replace=False,
+                 retries=5, retryDelay=1.0, maxRetryDelay=30.0, onCommit=None):
+        self.engine = engine
+        self.stats = stats
+        self.table = table
+        self.replace = replace
+        self._key = list(table.primary_key.columns)[0].name
+        self.batchSize = batchSize
+        self.interval = interval
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.onCommit = onCommit
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()  # 攒够一批时唤醒写入线程
+        self._closed = False
+        self._thread = threading.Thread(target=self._flushLoop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, row):
+        """加入一行（字典）"""
+        with self._lock:
+            self._rows.append(row)
+            pending = len(self._rows)
+        if pending >= self.batchSize * self._maxPendingBatches: self.flush()
+        elif pending >= self.batchSize: self._wake.set()
+
+    def flush(self):
+        """立即写入所有待写入行
+
+        :return: 写入的行数
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        count = 0
+        for start in range(0, len(rows), self.batchSize):
+            inserted = self._insert(rows[start:start + self.batchSize])
+            if inserted is None:  # 数据库暂时不可用，剩余的行放回待写入行的最前面
+                with self._lock:
+                    self._rows[:0] = rows[start:]
+                break
+            count += inserted
+        return count
+
+    def pending(self):
+        """返回待写入的行数"""
+        return len(self._rows)
+
+    def _statement(self):
+        """按数据库类型生成忽略或覆盖重复行的插入语句"""
+        dialect = self.engine.dialect.name
+        if self.replace:
+            if dialect == 'mysql':
+                statement = mysqlDialect.insert(self.table)
+                return statement.on_duplicate_key_update(
+                    {c.name: statement.inserted[c.name] for c in self.table.columns if c.name != self._key})
+            if dialect == 'sqlite': return self.table.insert().prefix_with('OR REPLACE')
+            return self.table.insert()
+        statement = self.table.insert()
+        prefix = self._ignorePrefix.get(dialect)
+        if prefix: statement = statement.prefix_with(prefix)
+        return statement
+
+    def _execute(self, statement, params):
+        """在一个事务中执行语句，暂时性错误按指数退避重试，重试retries次仍失败时抛出该错误"""
+        for attempt in range(self.retries + 1):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(statement, params)
+                return
+            except _transientErrors as e:
+                if attempt == self.retries: raise
+                delay = min(self.maxRetryDelay, self.retryDelay * 2 ** attempt)
+                logger.warning('Insert failed (%s), retrying in %.1fs' % (e.__class__.__name__, delay))
+                if self.stats is not None: self.stats.incr('insertRetried')
+                time.sleep(delay)
+
+    def _insert(self, rows):
+        """批量插入，同一批内md5重复的行只保留第一行（覆盖模式下保留最后一行）
+
+        :return: 写入的行数，数据库暂时不可用（重试后仍失败）时返回None，这些行需要保留
+        """
+        batch, keys = [], {}
+        for row in rows:
+            key = row[self._key]
+            if key in keys:
+                if self.replace: batch[keys[key]] = row
+                continue
+            keys[key] = len(batch)
+            batch.append(row)
+        statement = self._statement()
+        start = time.perf_counter()
+        try:
+            try:
+                self._execute(statement, batch)
+                count = len(batch)
+                committed = list(keys)
+            except _transientErrors:
+                raise
+            except SQLAlchemyError as e:  # 重复行（不支持忽略或覆盖重复行的数据库）或某一行有误，逐行插入
+                if not isinstance(e, IntegrityError):
+                    logger.warning('Batch insert failed (%s), inserting row by row' % e.__class__.__name__)
+                count, committed = self._insertRows(statement, batch)
+        except _transientErrors:
+            logger.exception('Database unavailable, %d rows kept for the next write' % len(batch))
+            return None
+        if self.stats is not None:
+            self.stats.observe('insert', time.perf_counter() - start)
+            self.stats.incr('stored', count)
+        if self.onCommit is not None and committed: self.onCommit(committed)
+        return count
+
+    def _insertRows(self, statement, batch):
+        """逐行插入，重复行跳过（覆盖模式下改为更新），出错的行记录日志后跳过，暂时性错误仍向上抛出
+
+        :return: (写入的行数, 已在表中的行（包括跳过的重复行）的主键列表)
+        """
+        key = self.table.c[self._key]
+        count = 0
+        committed = []
+        for row in batch:
+            try:
+                try:
+                    self._execute(statement, row)
+                    count += 1
+                except IntegrityError:
+                    if self.replace:
+                        self._execute(self.table.update().where(key == row[self._key]).values(row), None)
+                        count += 1
+                committed.append(row[self._key])
+            except _transientErrors:
+                raise
+            except SQLAlchemyError:
+                logger.exception('Insert failed, row dropped: ' + str(row[self._key]))
+                if self.stats is not None: self.stats.incr('insertFailed')
+        return count, committed
+
+    def _flushLoop(self):
+        """写入线程：每interval秒或攒够一批时写入"""
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        """停止写入线程并写入剩余行"""
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        if self._rows: logger.error('Database unavailable, %d rows not written' % len(self._rows))
 
 
 class SQLManager(object):
-    def __init__(self):
-        with open('data.conf') as json_file:
-            mysql = json.load(json_file)['mysql']
-            username = mysql['username']
-            password = mysql['password']
-            host = mysql['host']
-            port = mysql['port']
-            db = mysql['db']
-            engine = create_engine("mysql+pymysql://" + username + ":" + password + "@" +
-                                   host + ":" + port + "/" + db + "?charset=utf8", echo=False)
-            Session = sessionmaker(bind=engine)
-            self.session = scoped_session(Session)
+    """数据库管理
+
+    dbUrl：数据库连接URL（如sqlite:///test.db），默认使用配置中的dbUrl，没有时按mysql配置连接Mysql
+    stats：SpiderStats，记录批量写入的耗时与行数
+    replace：md5重复的行是否覆盖旧行（重新爬取时使用），默认忽略
+    conf：调用者已读取的配置字典，为None时读取data.conf
+    onCommit：批量写入提交后以已在表中的行的md5（十六进制）列表调用，见BatchWriter
+    不在这里建表，表由CreateTable.py显式创建
+    """
+    def __init__(self, dbUrl=None, stats=None, replace=False, conf=None, onCommit=None):
+        if conf is None:
+            with open('data.conf') as json_file:
+                conf = json.load(json_file)
+        self.md5ChunkSize = conf.get('md5ChunkSize', 10000)  # 启动时分块读取md5的每块行数
+        batchInsert = conf.get('batchInsert', {})
+        engine = create_engine(dbUrl or databaseUrl(conf), echo=False)  # 只在第一次使用时连接
+        self.engine = engine
+        Session = sessionmaker(bind=engine)
+        self.session = scoped_session(Session)
+        self.writer = BatchWriter(engine, Artical.__table__,
+                                  batchInsert.get('size', 200),  # 每批插入行数
+                                  batchInsert.get('intervalMs', 500) / 1000.0,  # 最长写入间隔
+                                  stats, replace,
+                                  batchInsert.get('retries', 5),  # 暂时性错误的重试次数
+                                  batchInsert.get('retryDelayMs', 1000) / 1000.0,  # 第一次重试前的等待时间
+                                  onCommit=onCommit)
 
     def insert(self, artical):
-        """每个工作者插入数据库"""
-        self.session().add(artical)
-        self.session().commit()
+        """每个工作者插入数据库（延迟批量写入），记录写入时间"""
+        row = {c.name: getattr(artical, c.name) for c in Artical.__table__.columns}
+        if row['inserted_at'] is None: row['inserted_at'] = int(time.time())
+        self.writer.add(row)
+
+    def flush(self):
+        """立即写入所有待写入的行"""
+        return self.writer.flush()
 
-    def getAllMd5(self):
-        """以字典形式返回数据库所有md5"""
-        obj = self.session().query(Artical)
-        md5Dict = {o.md5: True for o in obj}
-        return md5Dict
+    def close(self):
+        """写入剩余的行并停止写入线程"""
+        self.writer.close()
+
+    def getValidators(self, md5):
+        """读取已保存页面的条件请求信息
+
+        :param md5: url的md5（十六进制）
+        :return: 字典（etag，last_modified，content_hash），数据库中没有该url时返回None
+        """
+        statement = select(Artical.etag, Artical.last_modified, Artical.content_hash).where(Artical.md5 == md5)
+        with self.engine.connect() as conn:
+            row = conn.execute(statement).first()
+        if row is None: return None
+        return {'etag': row[0], 'last_modified': row[1], 'content_hash': row[2]}
+
+    def iterContents(self):
+        """按主键分页（每页md5ChunkSize行）依次返回所有文章的正文，不长时间占用游标"""
+        last = ''
+        while True:
+            statement = select(Artical.md5, Artical.content).where(Artical.md5 > last) \
+                .order_by(Artical.md5).limit(self.md5ChunkSize)
+            with self.engine.connect() as conn:
+                rows = conn.execute(statement).fetchall()
+            if not rows: break
+            for row in rows: yield row.content
+            last = rows[-1].md5
+
+    def getAllMd5(self, seenSet=None, accept=None, since=None):
+        """将数据库所有md5（转为16字节摘要）加入已解析URL集合并返回该集合
+
+        只查询md5一列，并使用服务端游标（流式结果）按md5ChunkSize行分块读取，
+        边读边加入集合，不会一次性把整张表载入内存
+        :param accept: 为None时加载所有md5，否则同时查询url，只加载accept(url)为True的行（多进程分片爬取时使用）
+        :param since: 为None时加载所有行，否则只加载inserted_at不早于since（秒）的行（按索引查询，用于补读快照之后写入的行）
+        """
+        if seenSet is None: seenSet = createSeenSet()
+        statement = select(Artical.md5) if accept is None else select(Artical.md5, Artical.url)
+        if since is not None: statement = statement.where(Artical.inserted_at >= since)
+        startTime = time.time()
+        count = 0
+        conn = self.engine.connect().execution_options(stream_results=True)
+        try:
+            result = conn.execute(statement)
+            while True:
+                rows = result.fetchmany(self.md5ChunkSize)
+                if not rows: break
+                for row in rows:
+                    if accept is None or accept(row[1]): seenSet.add(bytes.fromhex(row[0]))
+                count += len(rows)
+                if count % (self.md5ChunkSize * 100) < len(rows):  # 每读取100块输出一次进度
+                    logger.info('Loaded %d md5 (%.1fs)' % (count, time.time() - startTime))
+            result.close()
+        finally:
+            conn.close()
+        logger.info('Loaded all %d md5 in %.1fs' % (count, time.time() - startTime))
+        return seenSet
 
 if __name__ == '__main__':
     sqlManager = SQLManager()
-    print(sqlManager.getAllMd5())
-
+    print(len(sqlManager.getAllMd5()))
+    sqlManager.close()
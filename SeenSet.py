@@ -0,0 +1,203 @@
+import math
+import re
+
+_slotPattern = re.compile(rb'(?s)(?:\x00{16})*(.{16})')  # 跳过空槽，取下一个16字节的槽
+
+
+class DigestSet(object):
+    """精确的已解析URL集合，以16字节的原始md5摘要为键
+
+    所有摘要紧凑存放在一个bytearray中，采用开放寻址（线性探测），
+    每个元素仅占16字节（加上空槽），避免了str对象与dict槽位的开销
+    capacity：预计元素个数，超过负载因子后自动扩容
+    """
+    _width = 16  # md5摘要字节数
+    _empty = bytes(16)  # 空槽标记
+    _maxLoad = 0.7  # 最大负载因子
+
+    def __init__(self, capacity=1024):
+        slots = 16
+        while slots * self._maxLoad < capacity: slots *= 2
+        self._slots = slots
+        self._table = bytearray(slots * self._width)
+        self._size = 0
+        self._hasEmptyDigest = False  # 全零摘要与空槽标记相同，单独记录
+
+    def __len__(self):
+        return self._size + self._hasEmptyDigest
+
+    def _find(self, digest):
+        """返回摘要所在槽位或应插入的空槽位"""
+        mask = self._slots - 1
+        index = int.from_bytes(digest[:8], 'little') & mask
+        table = self._table
+        width = self._width
+        while True:
+            offset = index * width
+            slot = table[offset:offset + width]
+            if slot == digest or slot == self._empty:
+                return offset, slot == digest
+            index = (index + 1) & mask
+
+    def add(self, digest):
+        """加入摘要，若已存在则返回False"""
+        if digest == self._empty:
+            if self._hasEmptyDigest: return False
+            self._hasEmptyDigest = True
+            return True
+        offset, found = self._find(digest)
+        if found: return False
+        self._table[offset:offset + self._width] = digest
+        self._size += 1
+        if self._size > self._slots * self._maxLoad: self._resize(self._slots * 2)
+        return True
+
+    def __contains__(self, digest):
+        if digest == self._empty: return self._hasEmptyDigest
+        return self._find(digest)[1]
+
+    def __iter__(self):
+        """依次返回所有摘要（无序）
+
+        用正则在C层面跳过连续的空槽（每次匹配的长度都是槽宽的整数倍，不会错位），不逐个槽位切片
+        """
+        if self._hasEmptyDigest: yield self._empty
+        for match in _slotPattern.finditer(self._table):
+            digest = match.group(1)
+            if digest != self._empty: yield digest  # 表末尾全为空槽时最后一次匹配到的是空槽
+
+    def _resize(self, slots):
+        """扩容并重新插入所有摘要"""
+        oldTable = self._table
+        self._slots = slots
+        self._table = bytearray(slots * self._width)
+        for offset in range(0, len(oldTable), self._width):
+            digest = bytes(oldTable[offset:offset + self._width])
+            if digest != self._empty:
+                newOffset = self._find(digest)[0]
+                self._table[newOffset:newOffset + self._width] = digest
+
+
+class BloomFilter(object):
+    """定长布隆过滤器，直接使用md5摘要做双重哈希，无需再次哈希
+
+    capacity：可容纳元素个数
+    errorRate：容纳capacity个元素时的误判率
+    """
+    def __init__(self, capacity, errorRate):
+        self.capacity = capacity
+        self.errorRate = errorRate
+        bits = int(math.ceil(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self._bits = max(bits, 8)
+        self._hashes = max(int(math.ceil(math.log(1.0 / errorRate, 2))), 1)
+        self._array = bytearray((self._bits + 7) // 8)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        bits = self._bits
+        return [(h1 + i * h2) % bits for i in range(self._hashes)]
+
+    def add(self, digest):
+        """加入摘要，若（可能）已存在则返回False"""
+        isNew = False
+        array = self._array
+        for pos in self._positions(digest):
+            mask = 1 << (pos & 7)
+            if not array[pos >> 3] & mask:
+                array[pos >> 3] |= mask
+                isNew = True
+        if isNew: self._size += 1
+        return isNew
+
+    def __contains__(self, digest):
+        array = self._array
+        for pos in self._positions(digest):
+            if not array[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+
+
+class ScalableBloomFilter(object):
+    """可扩展布隆过滤器，当前过滤器装满后追加一个容量更大、误判率更低的过滤器，
+    使总体误判率始终不超过errorRate
+
+    capacity：第一个过滤器的容量
+    errorRate：总体误判率上限
+    growth：每个新过滤器的容量倍数
+    ratio：每个新过滤器的误判率收紧比例
+    """
+    def __init__(self, capacity=100000, errorRate=0.001, growth=2, ratio=0.5):
+        self.capacity = capacity
+        self.errorRate = errorRate
+        self.growth = growth
+        self.ratio = ratio
+        self._filters = []
+        self._addFilter()
+
+    def _addFilter(self):
+        index = len(self._filters)
+        capacity = self.capacity * (self.growth ** index)
+        errorRate = self.errorRate * (1 - self.ratio) * (self.ratio ** index)
+        self._filters.append(BloomFilter(capacity, errorRate))
+
+    def __len__(self):
+        return sum(len(f) for f in self._filters)
+
+    def add(self, digest):
+        """加入摘要，若（可能）已存在则返回False"""
+        if digest in self: return False
+        current = self._filters[-1]
+        if len(current) >= current.capacity:
+            self._addFilter()
+            current = self._filters[-1]
+        return current.add(digest)
+
+    def __contains__(self, digest):
+        for f in reversed(self._filters):
+            if digest in f: return True
+        return False
+
+
+class LayeredSeenSet(object):
+    """本次运行的已解析URL集合叠加在已保存文章的集合之上
+
+    add()只加入本次运行的集合，请求过的列表页、放弃的URL等不会进入已保存文章的集合（重启后仍会重新请求），
+    已保存文章的集合只由调用者在文章写入数据库后加入
+    current：本次运行的集合
+    stored：已保存文章的集合（如SnapshotSeenSet）
+    """
+    def __init__(self, current, stored):
+        self.current = current
+        self.stored = stored
+
+    def __len__(self):
+        return len(self.current) + len(self.stored)
+
+    def add(self, digest):
+        """加入摘要，若已存在则返回False"""
+        if digest in self.stored: return False
+        return self.current.add(digest)
+
+    def __contains__(self, digest):
+        return digest in self.current or digest in self.stored
+
+
+def createSeenSet(conf=None):
+    """按配置创建已解析URL集合
+
+    :param conf: 字典，type为exact（精确集合，默认）或bloom（可扩展布隆过滤器），
+                 capacity为初始容量，errorRate为布隆过滤器的误判率
+    :return: 支持add()与in操作的集合，元素为16字节md5摘要
+    """
+    conf = conf or {}
+    seenType = conf.get('type', 'exact')
+    capacity = conf.get('capacity', 1024)
+    if seenType == 'exact':
+        return DigestSet(capacity)
+    elif seenType == 'bloom':
+        return ScalableBloomFilter(capacity, conf.get('errorRate', 0.001))
+    raise ValueError('Unknown seen set type: ' + str(seenType))
@@ -0,0 +1,129 @@
+"""多进程分片爬取：启动多个ArticalSpider进程，按一致性哈希把域名分给各个进程，使爬取不再受限于一个gevent hub（一个核）
+
+    python ShardLauncher.py --shards 4
+
+每个分片有自己的协程池、解析进程、已解析URL集合、队列日志（urlQueueFileName.shard<i>）与溢出目录，
+发现的其它分片的链接经unix socket交给所属分片；所有分片都空闲且发出与收到的链接数相等并连续两次不变时结束
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from Sharding import socketPath
+
+logger = logging.getLogger('ArticalSpider.ShardLauncher')
+
+SPIDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ArticalSpider.py')
+
+
+class ShardLauncher(object):
+    """启动并监控分片进程，判断全部结束
+
+    shards：分片数
+    socketDir：各分片unix socket所在目录
+    pollInterval：查询各分片状态的间隔（秒）
+    stopTimeout：通知结束后等待分片进程退出的时间（秒），超时后强制结束
+    """
+    def __init__(self, shards, socketDir='shards', pollInterval=0.5, stopTimeout=60.0):
+        self.shards = shards
+        self.socketDir = socketDir
+        self.pollInterval = pollInterval
+        self.stopTimeout = stopTimeout
+        self.processes = []
+
+    def start(self):
+        if not os.path.exists(self.socketDir): os.makedirs(self.socketDir)
+        for shard in range(self.shards):
+            self.processes.append(subprocess.Popen([sys.executable, SPIDER, '--shard', str(shard),
+                                                    '--shards', str(self.shards)]))
+        logger.info('Started %d shards' % self.shards)
+
+    def _request(self, shard, message):
+        """向分片发送一条消息并读取一行回复，分片未开始监听或已退出时返回None"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        try:
+            sock.connect(socketPath(self.socketDir, shard))
+            sock.sendall(message.encode('utf-8') + b'\n')
+            with sock.makefile('r', encoding='utf-8') as reader:
+                return reader.readline().rstrip('\n') or None
+        except OSError:
+            return None
+        finally:
+            sock.close()
+
+    def status(self, shard):
+        """返回分片状态字典（idle，sent，received），无法连接时返回None"""
+        reply = self._request(shard, '?')
+        return json.loads(reply) if reply else None
+
+    def wait(self):
+        """等待所有分片结束爬取
+
+        所有分片都空闲、发出的链接总数等于收到的链接总数，并且两次查询之间计数没有变化时，
+        说明没有正在传递的链接，也没有分片在两次查询之间重新开始工作，通知所有分片结束
+        :return: 是否所有分片都正常结束
+        """
+        previous = None
+        while True:
+            exited = [shard for shard, process in enumerate(self.processes) if process.poll() is not None]
+            if exited:
+                logger.error('Shard %s exited unexpectedly' % exited)
+                self.stop()
+                return False
+            statuses = [self.status(shard) for shard in range(self.shards)]
+            if all(status is not None and status['idle'] for status in statuses) and \
+                    sum(status['sent'] for status in statuses) == sum(status['received'] for status in statuses):
+                counts = [(status['sent'], status['received']) for status in statuses]
+                if counts == previous: break
+                previous = counts
+            else:
+                previous = None
+            time.sleep(self.pollInterval)
+        logger.info('All shards idle, %d links routed between shards' % sum(status['sent'] for status in statuses))
+        return self.stop()
+
+    def stop(self):
+        """通知所有分片结束并等待退出
+
+        :return: 是否所有分片都正常退出
+        """
+        for shard, process in enumerate(self.processes):
+            if process.poll() is None: self._request(shard, '!')
+        deadline = time.time() + self.stopTimeout
+        ok = True
+        for process in self.processes:
+            try:
+                process.wait(max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            ok = ok and process.returncode == 0
+        return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a host-sharded crawl with one ArticalSpider process per shard')
+    parser.add_argument('--shards', type=int, help='number of shard processes (default: data.conf sharding.shards)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(name)s:%(levelname)s: %(message)s')
+    with open('data.conf') as json_file:
+        conf = json.load(json_file).get('sharding', {})
+    launcher = ShardLauncher(args.shards or conf.get('shards', os.cpu_count()), conf.get('socketDir', 'shards'),
+                             conf.get('pollInterval', 0.5))
+    launcher.start()
+    try:
+        ok = launcher.wait()
+    except KeyboardInterrupt:  # Ctrl-C同时发给了各分片进程，等待它们保存队列后退出
+        ok = launcher.stop()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
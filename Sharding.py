@@ -0,0 +1,164 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from urllib.parse import urlsplit
+
+import gevent
+from gevent.server import StreamServer
+
+logger = logging.getLogger('ArticalSpider.Sharding')
+
+
+def socketPath(socketDir, index):
+    """第index个分片的unix socket路径"""
+    return os.path.join(socketDir, 'shard%d.sock' % index)
+
+
+class HashRing(object):
+    """一致性哈希环，把域名映射到分片
+
+    每个分片在环上有replicas个虚拟节点，分片数变化时只有约1/分片数的域名改变归属
+    shards：分片数
+    replicas：每个分片的虚拟节点数
+    """
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        points = sorted((self._hash('%d-%d' % (shard, replica)), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def shardFor(self, host):
+        """返回负责域名host的分片编号"""
+        index = bisect.bisect(self._points, self._hash(host))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardRouter(object):
+    """分片之间的链接路由，每个分片在socketDir中监听一个unix socket
+
+    消息为一行文本：
+      +url\t链接文字 / ~url\t链接文字：交给所属分片的链接（~为低优先级）
+      ?：查询状态，回复一行JSON {"idle": 是否空闲, "sent": 已发出链接数, "received": 已处理链接数}
+      !：结束爬取，回复一行ok
+    发往其它分片的链接先在内存中按分片缓冲，由后台协程每flushInterval秒批量写入对应的socket
+    index：本分片编号
+    shards：分片数
+    socketDir：unix socket目录
+    onLinks：收到链接时调用onLinks(url, low, anchor)
+    isIdle：返回本分片是否空闲（队列为空且没有正在处理的URL）
+    onStop：收到结束消息时调用
+    """
+    def __init__(self, index, shards, socketDir, onLinks, isIdle, onStop, flushInterval=0.05, connectTimeout=30.0):
+        self.index = index
+        self.shards = shards
+        self.socketDir = socketDir
+        self.onLinks = onLinks
+        self.isIdle = isIdle
+        self.onStop = onStop
+        self.flushInterval = flushInterval
+        self.connectTimeout = connectTimeout
+        self.ring = HashRing(shards)
+        self.sent = 0  # 已写入其它分片socket的链接数
+        self.received = 0  # 已处理的其它分片发来的链接数
+        self._buffers = {}  # 分片编号 -> 待发送的消息行
+        self._sending = 0  # 已从缓冲取出、正在写入socket的链接数
+        self._peers = {}  # 分片编号 -> 已连接的socket
+        self._server = None
+        self._flusher = None
+
+    def owner(self, url):
+        """返回负责url的分片编号"""
+        return self.ring.shardFor(urlsplit(url).netloc.lower())
+
+    def start(self):
+        if not os.path.exists(self.socketDir): os.makedirs(self.socketDir, exist_ok=True)
+        path = socketPath(self.socketDir, self.index)
+        if os.path.exists(path): os.remove(path)  # 上次运行残留的socket文件
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(64)
+        self._server = StreamServer(listener, self._handle)
+        self._server.start()
+        self._flusher = gevent.spawn(self._flushLoop)
+
+    def send(self, shard, url, low=False, anchor=None):
+        """缓冲一个交给shard分片的链接
+
+        :param anchor: 链接文字，由所属分片用于计算优先级
+        """
+        anchor = ' '.join(anchor.split()) if anchor else ''  # 去掉制表符与换行
+        self._buffers.setdefault(shard, []).append(('~' if low else '+') + url + '\t' + anchor + '\n')
+
+    def pending(self):
+        """返回尚未发出的链接数"""
+        return sum(len(lines) for lines in self._buffers.values()) + self._sending
+
+    def _handle(self, sock, address):
+        """处理其它分片或启动器的连接，每行一条消息"""
+        reader = sock.makefile('r', encoding='utf-8')
+        try:
+            for line in reader:
+                kind, body = line[:1], line[1:].rstrip('\n')
+                if kind in '+~' and body:
+                    url, _, anchor = body.partition('\t')
+                    self.onLinks(url, kind == '~', anchor or None)
+                    self.received += 1
+                elif kind == '?':
+                    status = {'idle': self.pending() == 0 and self.isIdle(), 'sent': self.sent, 'received': self.received}
+                    sock.sendall((json.dumps(status) + '\n').encode('utf-8'))
+                elif kind == '!':
+                    self.onStop()
+                    sock.sendall(b'ok\n')
+        finally:
+            reader.close()
+
+    def _connect(self, shard):
+        """连接shard分片（其它分片可能尚未开始监听，在connectTimeout秒内重试）"""
+        deadline = time.time() + self.connectTimeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(socketPath(self.socketDir, shard))
+                return sock
+            except OSError:
+                sock.close()
+                if time.time() >= deadline: raise
+                gevent.sleep(0.1)
+
+    def _flush(self, shard):
+        lines = self._buffers.pop(shard, None)
+        if not lines: return
+        self._sending += len(lines)  # 连接与写入时会切换协程，期间这些链接仍计为未发出
+        try:
+            sock = self._peers.get(shard)
+            if sock is None: sock = self._peers[shard] = self._connect(shard)
+            sock.sendall(''.join(lines).encode('utf-8'))
+            self.sent += len(lines)
+        except OSError:
+            self._peers.pop(shard, None)
+            logger.error('Shard %d unreachable, %d links dropped' % (shard, len(lines)))
+        finally:
+            self._sending -= len(lines)
+
+    def _flushLoop(self):
+        while True:
+            gevent.sleep(self.flushInterval)
+            for shard in list(self._buffers): self._flush(shard)
+
+    def close(self):
+        if self._flusher is not None: self._flusher.kill()
+        for shard in list(self._buffers): self._flush(shard)
+        for sock in self._peers.values(): sock.close()
+        self._peers = {}
+        if self._server is not None: self._server.stop()
+        path = socketPath(self.socketDir, self.index)
+        if os.path.exists(path): os.remove(path)
@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from array import array
+from collections import Counter
+
+logger = logging.getLogger('ArticalSpider.SimHash')
+
+_lane = 32  # 每一位计数占用的位数
+_spread = [sum(((b >> i) & 1) << (_lane * i) for i in range(8)) for b in range(256)]  # 字节的8位分散到8个计数上
+_laneMask = (1 << _lane) - 1
+
+
+def simhash(text, shingle=3):
+    """计算文本的64位SimHash
+
+    特征为去掉空白后的连续shingle个字符（中文不需要分词），权重为出现次数；
+    每个特征取md5的前8字节，先按字节统计各字节值的权重，最后再展开为64位的计数，
+    避免对每个特征逐位累加
+    :return: 64位无符号整数
+    """
+    text = ''.join(text.split())
+    features = Counter(text[i:i + shingle] for i in range(max(1, len(text) - shingle + 1)))
+    histograms = [[0] * 256 for _ in range(8)]  # 第j字节 -> 字节值 -> 权重
+    total = 0
+    for feature, weight in features.items():
+        digest = hashlib.md5(feature.encode('utf-8')).digest()
+        total += weight
+        for j in range(8):
+            histograms[j][digest[j]] += weight
+    fingerprint = 0
+    for j, histogram in enumerate(histograms):
+        counts = 0  # 8个32位计数：该字节每一位为1的特征权重之和
+        for b, weight in enumerate(histogram):
+            if weight: counts += weight * _spread[b]
+        for i in range(8):
+            if ((counts >> (_lane * i)) & _laneMask) * 2 > total: fingerprint |= 1 << (8 * j + i)
+    return fingerprint
+
+
+class SimHashIndex(object):
+    """SimHash近似重复索引，查找汉明距离不超过distance的指纹
+
+    64位指纹分为distance + 1段，距离不超过distance的两个指纹至少有一段完全相同，
+    每段一张表（段值 -> 指纹数组），查找时只比较与某一段相同的候选指纹；
+    指纹以8字节无符号整数追加写入path，重启时载入
+    path：指纹文件，为None时不持久化
+    distance：认为是近似重复的最大汉明距离
+    load：是否在构造时载入已有的指纹文件（重新建立索引时不需要，也可以之后在后台调用load()）
+    """
+    def __init__(self, path=None, distance=3, load=True):
+        self.path = path
+        self.distance = distance
+        bands = distance + 1
+        self._bands = []  # (右移位数, 掩码)
+        start = 0
+        for index in range(bands):
+            width = 64 // bands + (1 if index < 64 % bands else 0)
+            self._bands.append((start, (1 << width) - 1))
+            start += width
+        self._tables = [{} for _ in self._bands]
+        self._count = 0
+        self._file = None
+        self.ready = True  # 指纹文件是否已载入完毕，载入期间find()的结果不完整
+        if path is not None and load: self.load()
+
+    def __len__(self):
+        return self._count
+
+    def _keys(self, fingerprint):
+        return [(fingerprint >> shift) & mask for shift, mask in self._bands]
+
+    def find(self, fingerprint):
+        """返回一个距离不超过distance的已有指纹，没有时返回None"""
+        for table, key in zip(self._tables, self._keys(fingerprint)):
+            for candidate in table.get(key, ()):
+                if bin(fingerprint ^ candidate).count('1') <= self.distance: return candidate
+        return None
+
+    def _insert(self, fingerprint):
+        for table, key in zip(self._tables, self._keys(fingerprint)):
+            bucket = table.get(key)
+            if bucket is None: bucket = table[key] = array('Q')
+            bucket.append(fingerprint)
+        self._count += 1
+
+    def add(self, fingerprint):
+        """加入指纹并追加写入指纹文件"""
+        self._insert(fingerprint)
+        if self.path is None: return
+        if self._file is None: self._file = open(self.path, 'ab')
+        self._file.write(fingerprint.to_bytes(8, 'little'))
+
+    def load(self, chunkSize=65536, pause=None):
+        """分块载入指纹文件，载入完毕前ready为False
+
+        只读取开始载入时文件中已有的指纹，载入期间add()的指纹直接加入索引，不会重复载入
+        :param pause: 每载入一块后调用（如gevent.sleep），使载入可以在后台协程中进行
+        """
+        if not os.path.exists(self.path): return
+        self.ready = False
+        with open(self.path, 'rb') as f:
+            remaining = os.fstat(f.fileno()).st_size // 8 * 8  # 忽略崩溃时写了一半的指纹
+            while remaining > 0:
+                chunk = f.read(min(chunkSize * 8, remaining))
+                if not chunk: break
+                remaining -= len(chunk)
+                fingerprints = array('Q')
+                fingerprints.frombytes(chunk)
+                for fingerprint in fingerprints: self._insert(fingerprint)
+                if pause is not None: pause()
+        self.ready = True
+        logger.info('Loaded %d simhash fingerprints' % self._count)
+
+    def rebuild(self, fingerprints):
+        """清空索引与指纹文件，用fingerprints（可迭代）重新建立，先写临时文件再替换
+
+        :return: 指纹个数
+        """
+        self.close()
+        self._tables = [{} for _ in self._bands]
+        self._count = 0
+        self.ready = True
+        tmpPath = self.path + '.tmp'
+        buffer = array('Q')
+        with open(tmpPath, 'wb') as f:
+            for fingerprint in fingerprints:
+                self._insert(fingerprint)
+                buffer.append(fingerprint)
+                if len(buffer) >= 65536:
+                    buffer.tofile(f)
+                    buffer = array('Q')
+            buffer.tofile(f)
+        os.replace(tmpPath, self.path)
+        return self._count
+
+    def flush(self):
+        if self._file is not None: self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _contentSimhash(content):
+    return simhash(content) if content else None
+
+
+def rebuildFromTable(sqlManager, index, pool, chunkSize=64, window=10000):
+    """用数据库中所有文章的正文重新建立索引
+
+    按主键分页读取正文，多进程计算SimHash，同时在途的正文不超过window篇，内存占用与文章数无关
+    :param pool: 计算SimHash的进程池（multiprocessing.Pool），应在创建带写入线程的sqlManager之前创建，由调用者关闭
+    :return: 指纹个数
+    """
+    slots = threading.BoundedSemaphore(window)
+
+    def contents():
+        for content in sqlManager.iterContents():
+            slots.acquire()  # Pool在后台线程中读取全部任务，取回结果前在这里阻塞
+            yield content
+
+    def fingerprints(results):
+        for fingerprint in results:
+            slots.release()
+            if fingerprint is not None: yield fingerprint
+
+    return index.rebuild(fingerprints(pool.imap_unordered(_contentSimhash, contents(), chunkSize)))
+
+
+if __name__ == '__main__':
+    import json
+    from SQLManager import SQLManager
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(name)s:%(levelname)s: %(message)s')
+    with open('data.conf') as json_file:
+        conf = json.load(json_file).get('nearDuplicate', {})
+    if not conf.get('path'): raise SystemExit('nearDuplicate.path is not configured in data.conf')
+    index = SimHashIndex(conf['path'], conf.get('distance', 3), load=False)
+    # 先创建计算进程，再创建带写入线程的数据库模块（fork时不复制数据库连接与线程）
+    pool = multiprocessing.Pool(os.cpu_count())
+    sqlManager = SQLManager()
+    try:
+        logger.info('Rebuilt %s with %d fingerprints' % (index.path, rebuildFromTable(sqlManager, index, pool)))
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        sqlManager.close()
+    pool.close()
+    pool.join()
@@ -0,0 +1,149 @@
+import json
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+
+class Histogram(object):
+    """固定桶的延迟直方图（单位为秒），记录一次观测只需一次二分查找"""
+    bounds = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)  # 最后一个桶为+Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """按桶上界估计分位数"""
+        if self.count == 0: return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avgMs': round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            'p50Ms': self.quantile(0.5) * 1000,
+            'p99Ms': self.quantile(0.99) * 1000,
+        }
+
+
+class SpiderStats(object):
+    """爬虫运行指标：各阶段延迟直方图、计数器以及实时读取的仪表
+
+    通过snapshot()得到字典快照，prometheus()得到Prometheus文本格式，
+    startServer()在本地开启HTTP端点（/metrics为Prometheus文本，/stats为JSON），
+    startReporter()定时把汇总信息写入日志，代替逐个URL输出日志
+    """
+    def __init__(self, prefix='artical_spider'):
+        self.prefix = prefix
+        self.startTime = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self._gauges = {}  # 名称 -> 返回当前值的函数
+        self._server = None
+        self._reporter = None
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None: histogram = self.histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """统计with语句块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def gauge(self, name, func):
+        """注册仪表，func在读取快照时调用"""
+        self._gauges[name] = func
+
+    def snapshot(self):
+        elapsed = time.time() - self.startTime
+        return {
+            'uptime': round(elapsed, 1),
+            'pagesPerSec': round(self.counters.get('fetched', 0) / elapsed, 2) if elapsed > 0 else 0.0,
+            'counters': dict(self.counters),
+            'gauges': {name: func() for name, func in self._gauges.items()},
+            'stages': {stage: h.snapshot() for stage, h in self.histograms.items()},
+        }
+
+    def prometheus(self):
+        """Prometheus文本格式"""
+        p = self.prefix
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE %s_%s_total counter' % (p, name))
+            lines.append('%s_%s_total %d' % (p, name, value))
+        for name, func in sorted(self._gauges.items()):
+            lines.append('# TYPE %s_%s gauge' % (p, name))
+            lines.append('%s_%s %s' % (p, name, func()))
+        if self.histograms:
+            lines.append('# TYPE %s_stage_seconds histogram' % p)
+        for stage, h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, n in zip(Histogram.bounds + ('+Inf',), h.buckets):
+                cumulative += n
+                lines.append('%s_stage_seconds_bucket{stage="%s",le="%s"} %d' % (p, stage, bound, cumulative))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (p, stage, h.sum))
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (p, stage, h.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """一行汇总信息，用于定时日志"""
+        snapshot = self.snapshot()
+        parts = ['%s=%s' % item for item in sorted(snapshot['counters'].items())]
+        parts += ['%s=%s' % item for item in sorted(snapshot['gauges'].items())]
+        parts += ['%s:%.1fms' % (stage, s['avgMs']) for stage, s in sorted(snapshot['stages'].items())]
+        return '%.2f pages/s ' % snapshot['pagesPerSec'] + ' '.join(parts)
+
+    def _app(self, environ, startResponse):
+        path = environ.get('PATH_INFO', '/')
+        if path == '/metrics':
+            body, contentType = self.prometheus(), 'text/plain; version=0.0.4'
+        elif path == '/stats':
+            body, contentType = json.dumps(self.snapshot()), 'application/json'
+        else:
+            startResponse('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found']
+        startResponse('200 OK', [('Content-Type', contentType)])
+        return [body.encode('utf-8')]
+
+    def startServer(self, host='127.0.0.1', port=9100):
+        """在后台协程中开启指标HTTP端点"""
+        self._server = WSGIServer((host, port), self._app, log=None)
+        self._server.start()
+        return self._server
+
+    def startReporter(self, interval, logger):
+        """每interval秒把汇总信息写入日志"""
+        def report():
+            while True:
+                gevent.sleep(interval)
+                logger.info('Stats: ' + self.summary())
+        self._reporter = gevent.spawn(report)
+        return self._reporter
+
+    def stop(self):
+        if self._reporter is not None: self._reporter.kill()
+        if self._server is not None: self._server.stop()
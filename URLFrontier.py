@@ -0,0 +1,243 @@
+import os
+from collections import deque
+
+from gevent.event import Event
+from gevent.queue import Empty
+
+
+class SegmentStore(object):
+    """磁盘URL段存储，只追加写入，按写入顺序读出
+
+    每个段文件最多保存segmentSize个URL（每行一个），读完的段文件会被直接删除
+    path：段文件存放目录
+    segmentSize：每个段文件最多存放的URL个数
+    """
+    def __init__(self, path, segmentSize=10000):
+        self.path = path
+        self.segmentSize = segmentSize
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        for name in os.listdir(self.path):  # 段文件只是溢出缓存，启动时清空上次残留
+            if name.endswith('.seg'): os.remove(os.path.join(self.path, name))
+
+        self._writeIndex = 0  # 当前写入段编号
+        self._writeCount = 0  # 当前写入段已写入URL个数
+        self._writer = None
+        self._readIndex = 0  # 当前读取段编号
+        self._reader = None
+        self._size = 0  # 磁盘中尚未读出的URL个数
+
+    def __len__(self):
+        return self._size
+
+    def _segmentPath(self, index):
+        return os.path.join(self.path, '%08d.seg' % index)
+
+    def append(self, url):
+        """追加一个URL到当前写入段，写满后切换到下一个段"""
+        if self._writer is None:
+            self._writer = open(self._segmentPath(self._writeIndex), 'a', encoding='utf-8')
+        self._writer.write(url + '\n')
+        self._writeCount += 1
+        self._size += 1
+        if self._writeCount >= self.segmentSize:
+            self._writer.close()
+            self._writer = None
+            self._writeIndex += 1
+            self._writeCount = 0
+
+    def popleft(self):
+        """按写入顺序读出一个URL
+
+        :return: URL字符串，磁盘中没有URL时返回None
+        """
+        while self._size > 0:
+            if self._reader is None:
+                if self._readIndex == self._writeIndex and self._writer is not None:
+                    self._writer.flush()  # 读写同一段时先把缓冲写入磁盘
+                self._reader = open(self._segmentPath(self._readIndex), 'r', encoding='utf-8')
+            line = self._reader.readline()
+            if line:
+                self._size -= 1
+                return line.rstrip('\n')
+            if self._readIndex < self._writeIndex:  # 当前段已读完，删除并读取下一段
+                self._reader.close()
+                self._reader = None
+                os.remove(self._segmentPath(self._readIndex))
+                self._readIndex += 1
+            else:
+                self._writer.flush()
+        return None
+
+    def __iter__(self):
+        """遍历磁盘中尚未读出的URL（不改变读取位置）"""
+        if self._writer is not None: self._writer.flush()
+        for index in range(self._readIndex, self._writeIndex + 1):
+            path = self._segmentPath(index)
+            if not os.path.exists(path): continue
+            with open(path, 'r', encoding='utf-8') as f:
+                if index == self._readIndex and self._reader is not None:
+                    f.seek(self._reader.tell())
+                for line in f:
+                    yield line.rstrip('\n')
+
+    def close(self):
+        """关闭文件并删除所有段文件"""
+        for f in (self._reader, self._writer):
+            if f is not None: f.close()
+        self._reader = self._writer = None
+        for index in range(self._readIndex, self._writeIndex + 1):
+            path = self._segmentPath(index)
+            if os.path.exists(path): os.remove(path)
+        self._size = 0
+
+
+class URLFrontier(object):
+    """内存热窗口 + 磁盘溢出的URL队列，可直接替换gevent.queue.Queue
+
+    内存中最多保存hotSize个URL，超出部分顺序追加到磁盘段文件，热窗口取空时再按顺序读回，
+    因此内存有界且put()永远不会因队列满而丢失URL；
+    putLow()加入的低优先级URL（如近似重复页面的出链）直接写入另一组段文件，只在其余URL都取完后才取出
+    hotSize：内存热窗口可存放的最大URL数
+    path：溢出段文件存放目录
+    segmentSize：每个段文件最多存放的URL个数
+    """
+    def __init__(self, hotSize, path, segmentSize=10000):
+        self.hotSize = hotSize
+        self._hot = deque()
+        self._spill = SegmentStore(path, segmentSize)
+        self._low = SegmentStore(os.path.join(path, 'low'), segmentSize)  # 低优先级URL
+        self._notEmpty = Event()  # 队列非空时置位，供阻塞的get()等待
+
+    def put(self, url, block=True, timeout=None, score=None):
+        """加入URL，热窗口满时溢出到磁盘（参数仅为兼容Queue与PriorityFrontier接口，从不阻塞，忽略score）"""
+        # 磁盘中还有URL时新URL也必须写入磁盘，保证先进先出
+        if len(self._spill) == 0 and len(self._hot) < self.hotSize:
+            self._hot.append(url)
+        else:
+            self._spill.append(url)
+        self._notEmpty.set()
+
+    def put_nowait(self, url):
+        self.put(url, False)
+
+    def putLow(self, url):
+        """加入低优先级URL"""
+        self._low.append(url)
+        self._notEmpty.set()
+
+    def get(self, block=True, timeout=None):
+        """取出URL，队列为空时等待timeout秒后抛出Empty"""
+        while True:
+            if not self._hot: self._refill()
+            if self._hot:
+                url = self._hot.popleft()
+                if not self._hot and len(self._spill) == 0 and len(self._low) == 0: self._notEmpty.clear()
+                return url
+            url = self._low.popleft()
+            if url is not None: return url
+            self._notEmpty.clear()
+            if not block or not self._notEmpty.wait(timeout):
+                raise Empty
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _refill(self):
+        """从磁盘按顺序读回URL填满热窗口"""
+        while len(self._hot) < self.hotSize:
+            url = self._spill.popleft()
+            if url is None: break
+            self._hot.append(url)
+
+    def qsize(self):
+        return len(self._hot) + len(self._spill) + len(self._low)
+
+    def spilled(self):
+        """返回溢出在磁盘中的URL数（包括低优先级URL）"""
+        return len(self._spill) + len(self._low)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    @property
+    def queue(self):
+        """按出队顺序返回所有URL（包括磁盘中的URL）"""
+        return list(self._hot) + list(self._spill) + list(self._low)
+
+    def close(self):
+        """关闭并清理磁盘段文件"""
+        self._spill.close()
+        self._low.close()
+
+
+class PriorityFrontier(object):
+    """按分数分级的URL队列，接口与URLFrontier相同，分数高的URL先取出
+
+    分数（0到1）均匀划分为levels级，每级是一个URLFrontier（级内先进先出，各有hotSize / levels的内存热窗口，
+    超出部分溢出到该级的磁盘段文件），get()总是从最高的非空级取出，因此内存有界且不会丢失URL；
+    putLow()加入的URL排在最低一级之后
+    hotSize：所有级内存热窗口的总URL数
+    path：溢出段文件存放目录，每级使用其中的一个子目录
+    scoreFunc：put()未给出分数时用于计算分数的函数（如重放日志、重试的URL）
+    levels：分级数
+    """
+    def __init__(self, hotSize, path, scoreFunc, levels=10, segmentSize=10000):
+        self.scoreFunc = scoreFunc
+        self._levels = [URLFrontier(max(1, hotSize // levels), os.path.join(path, 'p%d' % level), segmentSize)
+                        for level in range(levels)]
+        self._notEmpty = Event()
+
+    def _level(self, score):
+        return min(len(self._levels) - 1, max(0, int(score * len(self._levels))))
+
+    def put(self, url, block=True, timeout=None, score=None):
+        """按分数加入URL（从不阻塞）"""
+        if score is None: score = self.scoreFunc(url)
+        self._levels[self._level(score)].put(url)
+        self._notEmpty.set()
+
+    def put_nowait(self, url):
+        self.put(url, False)
+
+    def putLow(self, url):
+        self._levels[0].putLow(url)
+        self._notEmpty.set()
+
+    def get(self, block=True, timeout=None):
+        """取出分数最高一级中最早加入的URL，队列为空时等待timeout秒后抛出Empty"""
+        while True:
+            for level in reversed(self._levels):
+                if level.qsize(): return level.get_nowait()
+            self._notEmpty.clear()
+            if not block or not self._notEmpty.wait(timeout):
+                raise Empty
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return sum(level.qsize() for level in self._levels)
+
+    def spilled(self):
+        return sum(level.spilled() for level in self._levels)
+
+    def levelSizes(self):
+        """从高到低返回各级的URL数"""
+        return [level.qsize() for level in reversed(self._levels)]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return False
+
+    @property
+    def queue(self):
+        """按出队顺序返回所有URL"""
+        return [url for level in reversed(self._levels) for url in level.queue]
+
+    def close(self):
+        for level in self._levels: level.close()
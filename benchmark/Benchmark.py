@@ -0,0 +1,274 @@
+"""离线基准测试：解析（HtmlParser各方法ms/页）、写入（SQLite行/秒）、端到端爬取（本地链接图页/秒）
+
+    python benchmark/Benchmark.py all --output before.json
+    python benchmark/Benchmark.py parser --repeat 50
+    python benchmark/Benchmark.py parser --check  # 同时与golden/parser.json中的解析结果逐页比较
+
+结果以JSON输出，可在不同提交之间直接diff比较
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+GOLDEN_PATH = os.path.join(BENCH_DIR, 'golden', 'parser.json')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from LinkGraphServer import loadCorpus
+
+
+def peakRss():
+    """返回当前进程与已结束子进程的峰值内存（MB）"""
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    }
+
+
+def writeConf(workDir, **overrides):
+    """以仓库中的data.conf为基础，在workDir中写入测试用配置文件"""
+    with open(os.path.join(ROOT_DIR, 'data.conf')) as f:
+        data = json.load(f)
+    data['dbUrl'] = 'sqlite:///' + os.path.join(workDir, 'bench.db')
+    data.update(overrides)
+    with open(os.path.join(workDir, 'data.conf'), 'w') as f:
+        json.dump(data, f, indent='\t')
+    return data
+
+
+def benchParser(repeat):
+    """解析基准：每个语料页面重复解析repeat次，统计HtmlParser各方法的平均耗时"""
+    from AutoHtmlParser import HtmlParser
+    parser = HtmlParser()
+    pages = [(name, content.decode(charset)) for name, content, charset in loadCorpus()]
+    methods = [
+        ('tokenize', lambda html, title, lines: parser.tokenize(html)),
+        ('remove_tag', lambda html, title, lines: parser.remove_tag(html)),
+        ('extract_title', lambda html, title, lines: parser.extract_title(html)),
+        ('extract_keywords', lambda html, title, lines: parser.extract_keywords(html)),
+        ('extract_description', lambda html, title, lines: parser.extract_description(html)),
+        ('get_blocks', lambda html, title, lines: parser.get_blocks(lines)),
+        ('extract_content', lambda html, title, lines: parser.extract_content(html, title, lines)),
+        ('extract_offline', lambda html, title, lines: parser.extract_offline(html)),
+    ]
+    result = {'methods': {}, 'pages': {}}
+    for methodName, method in methods:
+        total = 0.0
+        for name, html in pages:
+            title = parser.extract_title(html)
+            lines = parser.remove_tag(html)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                method(html, title, lines)
+            elapsed = (time.perf_counter() - start) * 1000.0 / repeat
+            total += elapsed
+            if methodName == 'extract_offline':
+                result['pages'][name] = {'ms': round(elapsed, 4), 'bytes': len(html.encode('utf-8')),
+                                         'contentChars': len(parser.extract_offline(html)['content'])}
+        result['methods'][methodName] = round(total / len(pages), 4)  # ms/页
+    return result
+
+
+def parserOutputs():
+    """语料中每个页面的extract_offline解析结果：{文件名: 结果}"""
+    from AutoHtmlParser import HtmlParser
+    parser = HtmlParser()
+    return {name: parser.extract_offline(content.decode(charset)) for name, content, charset in loadCorpus()}
+
+
+def checkParser(path=GOLDEN_PATH):
+    """与golden文件比较语料的解析结果，返回不一致的页面及字段"""
+    with open(path, encoding='utf-8') as f:
+        golden = json.load(f)
+    outputs = parserOutputs()
+    mismatched = {}
+    for name in sorted(set(golden) | set(outputs)):
+        expected, actual = golden.get(name), outputs.get(name)
+        if expected is None or actual is None:
+            mismatched[name] = 'missing in ' + ('golden' if expected is None else 'corpus')
+            continue
+        fields = sorted(key for key in set(expected) | set(actual) if expected.get(key) != actual.get(key))
+        if fields: mismatched[name] = fields
+    return {'pages': len(outputs), 'mismatched': mismatched}
+
+
+def updateGolden(path=GOLDEN_PATH):
+    """把当前的解析结果写入golden文件（解析结果有意改变时使用）"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(parserOutputs(), f, indent=2, sort_keys=True, ensure_ascii=False)
+        f.write('\n')
+
+
+def benchStore(rows, workDir):
+    """写入基准：通过SQLite替身批量写入rows行（其中十分之一md5重复）"""
+    from CreateTable import Artical
+    from SQLiteManager import SQLiteManager
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        writeConf(workDir)
+        manager = SQLiteManager(os.path.join(workDir, 'store.db'))
+        content = '正文内容' * 1000
+        start = time.perf_counter()
+        for i in range(rows):
+            key = i - i % 10 if i % 10 == 9 else i
+            manager.insert(Artical(content=content, title='标题%d' % i, keyword='关键词', description='描述',
+                                   url='http://bench/%d' % key, md5='%032x' % key))
+        manager.close()
+        elapsed = time.perf_counter() - start
+        return {'rows': rows, 'stored': manager.count(), 'seconds': round(elapsed, 4),
+                'rowsPerSec': round(rows / elapsed, 1)}
+    finally:
+        os.chdir(cwd)
+
+
+def _freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def benchCrawl(pages, latency, poolSize, workDir, verbose=False, maxPoolSize=None, shards=1, hosts=1):
+    """端到端基准：启动本地链接图服务器，在子进程中运行ArticalSpider爬取整个图
+
+    maxPoolSize：自适应并发数的上限，为None时并发数固定为poolSize
+    shards：大于1时用ShardLauncher.py多进程分片爬取
+    hosts：页面分布的域名（回环地址）数，分片按域名划分，应大于shards
+    """
+    port = _freePort()
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'LinkGraphServer.py'),
+                               '--port', str(port), '--pages', str(pages), '--latency', str(latency),
+                               '--hosts', str(hosts)],
+                              stdout=subprocess.PIPE)
+    try:
+        server.stdout.readline()  # 等待服务器启动
+        baseUrl = 'http://127.0.0.1:%d' % port
+        crawlDir = os.path.join(workDir, 'crawl')
+        os.makedirs(crawlDir)
+        writeConf(crawlDir, startUrls=[baseUrl + '/page/0.html'],
+                  filterUrlsRegular=['http://127.0.0.%d:%d/' % (host + 1, port) for host in range(hosts)],
+                  poolSize=poolSize, politeness={'minDelay': 0, 'windowSize': 1000},
+                  concurrency={'minPoolSize': poolSize if maxPoolSize is None else 1,
+                               'maxPoolSize': maxPoolSize or poolSize},
+                  metrics={'port': 0, 'snapshotInterval': 0})
+        stderr = None if verbose else subprocess.DEVNULL
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '_crawl', '--shards', str(shards)],
+                                         cwd=crawlDir, stderr=stderr)
+        result = json.loads(output.decode('utf-8'))
+        with urllib.request.urlopen(baseUrl + '/stats') as r:
+            fetched = json.loads(r.read().decode('utf-8'))['requests']
+        result.update({'graphPages': pages, 'latency': latency, 'poolSize': poolSize, 'maxPoolSize': maxPoolSize,
+                       'shards': shards, 'hosts': hosts,
+                       'fetched': fetched,
+                       'pagesPerSec': round(fetched / result['seconds'], 2)})
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _crawlWorker(shards=1):
+    """在当前目录（由benchCrawl准备好配置）运行爬虫，输出JSON结果"""
+    if shards > 1:
+        _shardCrawlWorker(shards)
+        return
+    import ArticalSpider  # 最先导入，使gevent尽早打补丁
+    from SQLiteManager import SQLiteManager
+    manager = SQLiteManager(os.path.join(os.getcwd(), 'bench.db'))  # 与配置中的dbUrl为同一文件，先建表
+    start = time.perf_counter()
+    spider = ArticalSpider.ArticalSpider()
+    initSeconds = time.perf_counter() - start
+    spider.run()
+    elapsed = time.perf_counter() - start
+    stored = manager.count()
+    manager.close()
+    print(json.dumps({'seconds': round(elapsed, 4), 'initSeconds': round(initSeconds, 4),
+                      'stored': stored, 'peakRssMB': peakRss()}))
+
+
+def _shardCrawlWorker(shards):
+    """在当前目录用ShardLauncher.py运行shards个分片，输出JSON结果（包括所有分片进程的峰值内存）"""
+    from SQLiteManager import SQLiteManager
+    manager = SQLiteManager(os.path.join(os.getcwd(), 'bench.db'))
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(ROOT_DIR, 'ShardLauncher.py'), '--shards', str(shards)],
+                          stdout=sys.stderr)
+    elapsed = time.perf_counter() - start
+    stored = manager.count()
+    manager.close()
+    print(json.dumps({'seconds': round(elapsed, 4), 'initSeconds': None, 'stored': stored, 'peakRssMB': peakRss()}))
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline fetch/parse/store benchmarks')
+    parser.add_argument('scenario', choices=['all', 'parser', 'store', 'crawl', '_crawl'])
+    parser.add_argument('--repeat', type=int, default=20, help='parser: runs per page and method')
+    parser.add_argument('--rows', type=int, default=5000, help='store: rows to insert')
+    parser.add_argument('--pages', type=int, default=200, help='crawl: pages in the link graph')
+    parser.add_argument('--latency', type=float, default=0.02, help='crawl: server latency per page (s)')
+    parser.add_argument('--pool-size', type=int, default=10, help='crawl: spider poolSize')
+    parser.add_argument('--max-pool-size', type=int, help='crawl: enable adaptive concurrency up to this many requests')
+    parser.add_argument('--shards', type=int, default=1, help='crawl: run this many shard processes via ShardLauncher.py')
+    parser.add_argument('--hosts', type=int, default=1, help='crawl: spread the link graph over this many loopback hosts')
+    parser.add_argument('--check', action='store_true', help='parser: compare extract_offline output with golden/parser.json')
+    parser.add_argument('--update-golden', action='store_true', help='parser: rewrite golden/parser.json from the current output')
+    parser.add_argument('--output', help='write JSON result to this file')
+    parser.add_argument('--verbose', action='store_true', help='show spider log output')
+    args = parser.parse_args()
+
+    if args.scenario == '_crawl':
+        _crawlWorker(args.shards)
+        return
+    if args.update_golden:
+        updateGolden()
+        print('Updated ' + GOLDEN_PATH)
+        return
+
+    workDir = tempfile.mkdtemp(prefix='artical-bench-')
+    result = {'commit': gitCommit(), 'python': platform.python_version(), 'scenarios': {}}
+    try:
+        if args.scenario in ('all', 'parser'):
+            result['scenarios']['parser'] = benchParser(args.repeat)
+            if args.check: result['scenarios']['parser']['golden'] = checkParser()
+        if args.scenario in ('all', 'store'):
+            result['scenarios']['store'] = benchStore(args.rows, workDir)
+        if args.scenario in ('all', 'crawl'):
+            result['scenarios']['crawl'] = benchCrawl(args.pages, args.latency, args.pool_size, workDir, args.verbose,
+                                                     args.max_pool_size, args.shards, args.hosts)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    result['peakRssMB'] = peakRss()
+
+    text = json.dumps(result, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    if args.check and result['scenarios'].get('parser', {}).get('golden', {}).get('mismatched'):
+        sys.exit('Parser output differs from ' + GOLDEN_PATH)
+
+
+if __name__ == '__main__':
+    main()
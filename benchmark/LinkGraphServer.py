@@ -0,0 +1,133 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+_charset = re.compile(rb'<meta[^>]*?charset=["\']?([\w-]+)', re.I)
+
+
+def loadCorpus(path=CORPUS_DIR):
+    """读取语料目录中的所有页面
+
+    :return: 列表，每一项为(文件名, 原始字节, 页面声明的编码)
+    """
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.html'): continue
+        with open(os.path.join(path, name), 'rb') as f:
+            content = f.read()
+        charset = _charset.search(content[:2048])
+        pages.append((name, content, charset.group(1).decode('ascii').lower() if charset else 'utf-8'))
+    return pages
+
+
+class LinkGraph(object):
+    """确定性的合成链接图：第n个页面使用第n % len(corpus)个语料页面，并在</body>前插入outLinks个指向其它页面的链接
+
+    pages：页面总数
+    outLinks：每个页面的出链数
+    seed：随机种子，相同参数总是生成相同的图
+    hosts：页面分布的域名数，大于1时第n个页面位于回环地址127.0.0.<1 + n % hosts>（用于测试按域名分片）
+    """
+    def __init__(self, corpus, pages=200, outLinks=8, seed=2017, hosts=1):
+        self.corpus = corpus
+        self.pages = pages
+        self.outLinks = outLinks
+        self.seed = seed
+        self.hosts = hosts
+
+    def pageUrl(self, node, baseUrl):
+        """第node个页面的URL"""
+        if self.hosts > 1: baseUrl = 'http://127.0.0.%d:%d' % (1 + node % self.hosts, urlsplit(baseUrl).port)
+        return '%s/page/%d.html' % (baseUrl, node)
+
+    def render(self, node, baseUrl):
+        name, content, charset = self.corpus[node % len(self.corpus)]
+        rnd = random.Random(self.seed * 1000003 + node)
+        links = ''.join('<li><a href="%s">page %d</a></li>\n' % (self.pageUrl(target, baseUrl), target)
+                        for target in (rnd.randrange(self.pages) for _ in range(self.outLinks)))
+        marker = content.rfind(b'</body>')
+        if marker < 0: marker = len(content)
+        body = content[:marker] + ('<ul class="graph">\n%s</ul>\n' % links).encode('ascii') + content[marker:]
+        # gbk等页面不在响应头中声明编码，使爬虫走编码检测流程
+        contentType = 'text/html; charset=utf-8' if charset == 'utf-8' else 'text/html'
+        return body, contentType
+
+
+class LinkGraphServer(ThreadingHTTPServer):
+    """本地HTTP服务器，提供合成链接图，每个请求延迟latency秒
+
+    /page/<n>.html：第n个页面（带ETag，支持If-None-Match条件请求）
+    /stats：已服务的页面请求数（JSON）
+    """
+    daemon_threads = True
+
+    def __init__(self, address, graph, latency=0.0):
+        ThreadingHTTPServer.__init__(self, address, _Handler)
+        self.graph = graph
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def baseUrl(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持长连接
+    _page = re.compile(r'^/page/(\d+)\.html$')
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/stats':
+            self._send(200, json.dumps({'requests': server.requests}).encode('ascii'), 'application/json')
+            return
+        match = self._page.match(self.path)
+        if not match or int(match.group(1)) >= server.graph.pages:
+            self._send(404, b'not found', 'text/plain')
+            return
+        if server.latency > 0: time.sleep(server.latency)
+        with server._lock:
+            server.requests += 1
+        body, contentType = server.graph.render(int(match.group(1)), server.baseUrl)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'', contentType, etag)
+            return
+        self._send(200, body, contentType, etag)
+
+    def _send(self, status, body, contentType, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        if etag is not None: self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic link graph built from the benchmark corpus')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--pages', type=int, default=200, help='number of pages in the graph')
+    parser.add_argument('--out-links', type=int, default=8, help='links per page')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each response')
+    parser.add_argument('--hosts', type=int, default=1,
+                        help='spread pages over this many loopback addresses 127.0.0.1..N (listens on all of them)')
+    args = parser.parse_args()
+    graph = LinkGraph(loadCorpus(), args.pages, args.out_links, hosts=args.hosts)
+    server = LinkGraphServer(('0.0.0.0' if args.hosts > 1 else args.host, args.port), graph, args.latency)
+    print('Serving %d pages on %s' % (args.pages, graph.pageUrl(0, server.baseUrl)), flush=True)
+    server.serve_forever()
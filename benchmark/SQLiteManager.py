@@ -0,0 +1,24 @@
+import os
+import sys
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CreateTable import creteTable
+from SQLManager import SQLManager
+
+
+class SQLiteManager(SQLManager):
+    """SQLManager的SQLite替身，不需要Mysql即可测试写入
+
+    path：SQLite数据库文件，不存在时自动创建artical表（与SQLManager一样从当前目录读取data.conf中的批量写入配置）
+    """
+    def __init__(self, path):
+        SQLManager.__init__(self, 'sqlite:///' + os.path.abspath(path))
+        creteTable(self.engine)
+
+    def count(self):
+        """返回artical表的行数"""
+        with self.engine.connect() as conn:
+            return conn.execute(text('SELECT COUNT(*) FROM artical')).scalar()